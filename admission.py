@@ -0,0 +1,316 @@
+"""
+Admission control in front of the Moira executor, so that a single
+caller can't hog all the Moira worker processes (or the Moira server).
+
+Every query has a cost (1 unless it is known to be expensive). A query
+only runs if both the global in-flight cost and the caller's in-flight
+cost stay under their caps (callers are told apart by their credential,
+see query_cache.current_credential, since nothing checks the kerb a token
+claims to be); otherwise it waits in a bounded queue. If
+the queue is full, or the query waits for too long, it is rejected with
+an `Overloaded` error, which the API turns into a 429 or 503.
+
+By default, the limits are per server process, so they only do much with
+threaded workers: a sync worker process only serves one request at a time.
+To enforce them across all the processes on a host, set MOIRA_ADMISSION_DB
+to the path of a SQLite database for them to share (see
+SharedAdmissionController).
+"""
+
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+from deadlines import DeadlineExceeded
+from query_cache import current_credential
+from sqlite_db import SQLiteDatabase
+
+# Total cost of the queries that may run at once
+MAX_CONCURRENCY = int(os.environ.get('MOIRA_MAX_CONCURRENCY', 16))
+
+# Total cost of the queries that a single kerb may run at once
+MAX_CONCURRENCY_PER_USER = int(os.environ.get('MOIRA_MAX_CONCURRENCY_PER_USER', 4))
+
+# How many queries may wait for a slot (and how many of them from the same kerb)
+MAX_QUEUE = int(os.environ.get('MOIRA_MAX_QUEUE', 64))
+MAX_QUEUE_PER_USER = int(os.environ.get('MOIRA_MAX_QUEUE_PER_USER', 8))
+
+# How long (in seconds) a query may wait for a slot
+MAX_QUEUE_WAIT = float(os.environ.get('MOIRA_MAX_QUEUE_WAIT', 10))
+
+# Database shared by the processes on a host, to enforce the limits across them
+ADMISSION_DB = os.environ.get('MOIRA_ADMISSION_DB')
+
+# Queries that are known to be expensive count as several queries
+QUERY_COSTS = {
+    'qualified_get_lists': 8,
+    'get_end_members_of_list': 4,
+    'get_lists_of_member': 2,
+    'get_ace_use': 2,
+}
+
+# Kerb that the caller on whose behalf queries are being run claims to be
+# (set by the webathena decorator). Background work runs as None.
+current_principal: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    'current_principal', default=None
+)
+
+
+class Overloaded(Exception):
+    """
+    Raised when a query is not admitted
+    """
+
+    def __init__(self, status_code, name, message, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.name = name
+        self.message = message
+        self.retry_after = retry_after
+
+
+def query_cost(query):
+    # A query must be able to run on its own, however expensive it is
+    return min(QUERY_COSTS.get(query, 1), MAX_CONCURRENCY, MAX_CONCURRENCY_PER_USER)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency, max_concurrency_per_user,
+                 max_queue, max_queue_per_user, max_queue_wait):
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_user = max_concurrency_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue_wait = max_queue_wait
+
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.in_flight_by_user = Counter()
+        self.waiting = 0
+        self.waiting_by_user = Counter()
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def _fits(self, principal, cost):
+        return (self.in_flight + cost <= self.max_concurrency and
+                self.in_flight_by_user[principal] + cost <= self.max_concurrency_per_user)
+
+    def _reject(self, reason, status_code, name, message, retry_after):
+        self.rejected[reason] += 1
+        return Overloaded(status_code, name, message, math.ceil(retry_after))
+
+    def _timed_out(self, timeout, what):
+        """
+        The error for a query that waited for as long as it could
+        """
+        if timeout < self.max_queue_wait:
+            # It was the request that ran out of time, not the queue
+            return DeadlineExceeded(what, timeout)
+        return self._reject(
+            'queue_timeout', 503, 'SERVER_BUSY',
+            'Timed out waiting for the server, try again later', self.max_queue_wait,
+        )
+
+    def _wait(self, principal, cost, timeout, what):
+        """
+        Waits in the queue until the query fits (called with the lock held)
+        """
+        if self.waiting_by_user[principal] >= self.max_queue_per_user:
+            raise self._reject(
+                'user_queue_full', 429, 'TOO_MANY_REQUESTS',
+                'You have too many Moira queries in progress, try again later', 1,
+            )
+        if self.waiting >= self.max_queue:
+            raise self._reject(
+                'queue_full', 503, 'SERVER_BUSY',
+                'The server is too busy, try again later', self.max_queue_wait,
+            )
+        deadline = time.monotonic() + min(self.max_queue_wait, timeout)
+        self.waiting += 1
+        self.waiting_by_user[principal] += 1
+        try:
+            while not self._fits(principal, cost):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timed_out(timeout, what)
+                self._cond.wait(remaining)
+        finally:
+            self.waiting -= 1
+            self.waiting_by_user[principal] -= 1
+            if not self.waiting_by_user[principal]:
+                del self.waiting_by_user[principal]
+
+    @contextlib.contextmanager
+    def admit(self, principal, cost=1, timeout=math.inf, what='query'):
+        """
+        Context manager holding a slot of the given cost while the query runs.
+        It waits for at most `timeout` seconds (or MAX_QUEUE_WAIT if lower);
+        if `timeout` is what runs out, it raises DeadlineExceeded for `what`.
+        """
+        with self._cond:
+            if not self._fits(principal, cost):
+                self._wait(principal, cost, timeout, what)
+            self.in_flight += cost
+            self.in_flight_by_user[principal] += cost
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= cost
+                self.in_flight_by_user[principal] -= cost
+                if not self.in_flight_by_user[principal]:
+                    del self.in_flight_by_user[principal]
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': self.in_flight,
+                'max_concurrency': self.max_concurrency,
+                'queue_depth': self.waiting,
+                'max_queue': self.max_queue,
+                'active_users': len(self.in_flight_by_user),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+            }
+
+
+class SharedAdmissionController(AdmissionController):
+    """
+    Same limits, but enforced across every process using the same SQLite
+    database. Running and waiting queries are rows in it, and waiting ones
+    check for a free slot every POLL_INTERVAL seconds.
+
+    Rows expire (in case their process dies) once the query would have been
+    stopped by its deadline anyway, plus LEASE_MARGIN.
+    """
+
+    POLL_INTERVAL = 0.05
+    LEASE_MARGIN = 60
+    # For queries with no deadline
+    MAX_LEASE = 600
+
+    def __init__(self, path, *args):
+        super().__init__(*args)
+        self.path = path
+        self._database = SQLiteDatabase(path)
+        self._database.execute("""
+            CREATE TABLE IF NOT EXISTS slots (
+                id INTEGER PRIMARY KEY,
+                principal TEXT,
+                cost INTEGER NOT NULL,
+                -- 1 while it is in the queue, 0 once it runs
+                waiting INTEGER NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._database.transaction() as db:
+            db.execute('DELETE FROM slots WHERE expires < ?', (time.time(),))
+            yield db
+
+    def _fits_in(self, db, principal, cost):
+        in_flight, in_flight_by_user = db.execute(
+            'SELECT TOTAL(cost), TOTAL(CASE WHEN principal IS ? THEN cost END) FROM slots WHERE waiting = 0',
+            (principal,),
+        ).fetchone()
+        return (in_flight + cost <= self.max_concurrency and
+                in_flight_by_user + cost <= self.max_concurrency_per_user)
+
+    def _enter(self, principal, cost, timeout, what):
+        """
+        Waits for a slot, and returns its id
+        """
+        lease = min(timeout, self.MAX_LEASE) + self.LEASE_MARGIN
+        with self._transaction() as db:
+            if self._fits_in(db, principal, cost):
+                return db.execute(
+                    'INSERT INTO slots (principal, cost, waiting, expires) VALUES (?, ?, 0, ?)',
+                    (principal, cost, time.time() + lease),
+                ).lastrowid
+            waiting, waiting_by_user = db.execute(
+                'SELECT COUNT(*), TOTAL(principal IS ?) FROM slots WHERE waiting = 1', (principal,),
+            ).fetchone()
+            if waiting_by_user >= self.max_queue_per_user:
+                raise self._reject(
+                    'user_queue_full', 429, 'TOO_MANY_REQUESTS',
+                    'You have too many Moira queries in progress, try again later', 1,
+                )
+            if waiting >= self.max_queue:
+                raise self._reject(
+                    'queue_full', 503, 'SERVER_BUSY',
+                    'The server is too busy, try again later', self.max_queue_wait,
+                )
+            slot = db.execute(
+                'INSERT INTO slots (principal, cost, waiting, expires) VALUES (?, ?, 1, ?)',
+                (principal, cost, time.time() + lease),
+            ).lastrowid
+
+        deadline = time.monotonic() + min(self.max_queue_wait, timeout)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timed_out(timeout, what)
+                time.sleep(min(self.POLL_INTERVAL, remaining))
+                with self._transaction() as db:
+                    if self._fits_in(db, principal, cost):
+                        db.execute(
+                            'UPDATE slots SET waiting = 0, expires = ? WHERE id = ?',
+                            (time.time() + lease, slot),
+                        )
+                        return slot
+        except BaseException:
+            self._database.execute('DELETE FROM slots WHERE id = ?', (slot,))
+            raise
+
+    @contextlib.contextmanager
+    def admit(self, principal, cost=1, timeout=math.inf, what='query'):
+        slot = self._enter(principal, cost, timeout, what)
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self._database.execute('DELETE FROM slots WHERE id = ?', (slot,))
+
+    def stats(self):
+        in_flight, waiting, active_users = self._database.execute(
+            """
+            SELECT TOTAL(CASE WHEN waiting = 0 THEN cost END), TOTAL(waiting),
+                   COUNT(DISTINCT CASE WHEN waiting = 0 THEN principal END)
+            FROM slots WHERE expires >= ?
+            """,
+            (time.time(),),
+        ).fetchone()
+        return {
+            'in_flight': int(in_flight),
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': int(waiting),
+            'max_queue': self.max_queue,
+            'active_users': active_users,
+            # Of this process
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+        }
+
+
+_limits = (MAX_CONCURRENCY, MAX_CONCURRENCY_PER_USER, MAX_QUEUE, MAX_QUEUE_PER_USER, MAX_QUEUE_WAIT)
+if ADMISSION_DB:
+    controller = SharedAdmissionController(ADMISSION_DB, *_limits)
+else:
+    controller = AdmissionController(*_limits)
+
+
+def admit(query, timeout=math.inf):
+    """
+    Waits for a slot for the given query on behalf of the current credential
+    (see AdmissionController.admit)
+    """
+    return controller.admit(current_credential.get(), query_cost(query), timeout, query)
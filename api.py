@@ -1,99 +1,212 @@
+import contextvars
+import logging
+import os
 import subprocess
-from flask import Flask, request, Response
-from decorators import jsoned, webathena, plaintext, authenticated_moira
+import sys
+import urllib.parse
+from flask import Flask, Blueprint, request, Response, g, current_app
+from werkzeug.exceptions import HTTPException
+from decorators import jsoned, webathena, plaintext, authenticated_moira, credential_cache, get_webathena_token
 from util import *
-from flask_cors import CORS
-from mailman import mailman_request_subscription, mailman_request_unsubscription
-
-app = Flask(__name__)
-CORS(app) # to actually use the API from JavaScript
-
+from moira_query import CLIENT_NAME, ccache_env, moira_query_cred
+from list_search import get_list_index, search, shareable
+import admission
+import deadlines
+import timing
+import query_cache
+import list_watch
+import jobs
+import profiling
+from expand import ExpandError, Loader, parse_expand, expand_lists, expand_members
+import setops
+from jobs import allow_async
+
+# The routes are in a blueprint so that the app itself is made by create_app
+# (see the bottom of this file)
+# https://flask.palletsprojects.com/en/2.2.x/patterns/appfactories/
 # I wanted to separate this into multiple files, but it seems non-trivial: 
 # https://www.reddit.com/r/flask/comments/m3kp1i/splitting_flask_app_into_multiple_files/
-# https://flask.palletsprojects.com/en/2.2.x/patterns/appfactories/
 # So I think one file will suffice
+bp = Blueprint('api', __name__)
+
+@bp.before_app_request
+def start_timing():
+    timing.start_request(request.headers.get('X-Request-Id'))
+
+
+@bp.after_app_request
+def end_timing(response):
+    return timing.end_request(response, request.method, request.path)
+
+
+@bp.before_app_request
+def set_deadline():
+    try:
+        timeout = deadlines.parse_timeout(request.headers.get('Request-Timeout'))
+    except ValueError:
+        return {'description': 'Request-Timeout must be a positive number of seconds'}, 400
+    deadlines.start_request(timeout)
+
+
+@bp.before_app_request
+def resume_jobs():
+    jobs.resume(current_app._get_current_object())
+
+
+@bp.after_app_request
+def add_etag(response):
+    # Lets clients revalidate with If-None-Match instead of downloading
+    # the same result again (the Moira queries still run, though)
+    if request.method == 'GET' and response.status_code == 200 \
+            and not response.is_streamed and 'ETag' not in response.headers:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
 
-@app.get('/')
+
+@bp.get('/')
 @plaintext
 def home():
     return 'Welcome to the Moira API!\nFor documentation see: https://github.com/gabrc52/moira-rest-api/'
 
-@app.get('/status')
+@bp.get('/status')
 @webathena
 def ticket_status(kerb):
     # https://stackoverflow.com/a/22357424
     return {
-        'status': 'ok' if subprocess.call(['klist', '-s']) == 0 else 'expired'
+        'status': 'ok' if subprocess.call(['klist', '-s'], env=ccache_env()) == 0 else 'expired'
     }
 
 
-@app.get('/klist')
+@bp.get('/stats')
+def stats():
+    return {
+        'admission': admission.controller.stats(),
+        'timeouts': deadlines.timeout_counts(),
+        'raw_query_cache': query_cache.stats(),
+        'credential_cache': credential_cache.stats(),
+        'jobs': jobs.stats() if os.path.exists(jobs.JOBS_DB) else {},
+    }
+
+
+@bp.get('/klist')
 @webathena
 @plaintext
 def klist(kerb):
-    result = subprocess.run(['klist', '-f'], stdout=subprocess.PIPE)
+    result = subprocess.run(['klist', '-f'], stdout=subprocess.PIPE, env=ccache_env())
     return result.stdout.decode()
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     return {
         'name': 'METHOD_NOT_FOUND',
         'description': f'{error}',
     }
 
-@app.errorhandler(405)
+@bp.app_errorhandler(ExpandError)
+def invalid_expand(error):
+    return {
+        'name': error.name,
+        'description': error.message,
+    }, 400
+
+@bp.app_errorhandler(405)
 def method_not_allowed(error):
     return {
         'name': 'METHOD_NOT_ALLOWED',
         'description': "The HTTP method you're trying to use is not allowed or has not been implemented for this URL",
     }
 
-@app.get('/whoami')
+@bp.get('/whoami')
 @webathena
 @plaintext
 def whoami(kerb):
     return kerb
 
 
-@app.route('/raw_query/<string:query>', methods=['GET', 'POST'])
+@bp.route('/raw_query/<string:query>', methods=['GET', 'POST'])
 @authenticated_moira
 def raw_query(moira_query, query, kerb):
     parameters = request.args.getlist('arg')
-    res = moira_query(query, *parameters)
-    return res
+    res, cache_status = query_cache.cached_query(moira_query, query, parameters)
+    return res, {'X-Cache': cache_status}
+
+
+MAX_BATCH_SIZE = 100
 
+# Endpoints that can't be part of a batch (they never finish, or would nest)
+UNBATCHABLE_ENDPOINTS = {'api.batch', 'api.watch_lists', 'api.watch_list'}
 
-@app.get('/users/<string:user>/')
+@bp.post('/batch')
+def batch():
+    """
+    Runs several API requests in one round trip, one after the other,
+    with the same authentication (and modwith) and deadline as the batch itself
+    """
+    body = request.get_json(silent=True)
+    requests = body.get('requests') if isinstance(body, dict) else None
+    if not isinstance(requests, list) or len(requests) > MAX_BATCH_SIZE:
+        return {'description': f'requests must be a list of at most {MAX_BATCH_SIZE} requests'}, 400
+
+    headers = {header: request.headers[header] for header in ('modwith',) if header in request.headers}
+    token = get_webathena_token()
+    if token:
+        # Even if the batch got it as a parameter
+        headers['Authorization'] = f'webathena {token}'
+    client = current_app.test_client()
+    responses = []
+    for sub_request in requests:
+        if not isinstance(sub_request, dict):
+            responses.append({'status': 400, 'body': {'description': 'each request must be an object'}})
+            continue
+        method = str(sub_request.get('method', 'GET')).upper()
+        path = sub_request.get('path')
+        if not isinstance(path, str) or not path.startswith('/'):
+            responses.append({'status': 400, 'body': {'description': 'path must start with /'}})
+            continue
+        try:
+            # Match the path the way it will be routed (i.e. decoded)
+            route_path = urllib.parse.unquote(path.partition('?')[0])
+            endpoint, _ = current_app.url_map.bind('').match(route_path, method)
+        except HTTPException:
+            # Let the request fail the usual way
+            endpoint = None
+        if endpoint in UNBATCHABLE_ENDPOINTS:
+            responses.append({'status': 400, 'body': {'description': f'{path} can not be batched'}})
+            continue
+        # The whole batch must fit in its deadline, so each request only gets what is left of it
+        timeout = deadlines.time_left()
+        if timeout <= 0:
+            responses.append({'status': 504, 'body': {
+                'code': None,
+                'name': 'TIMEOUT',
+                'message': 'The batch ran out of time before this request could run',
+            }})
+            continue
+        headers['Request-Timeout'] = str(timeout)
+        # Each request gets its own timings and deadline
+        response = contextvars.copy_context().run(
+            client.open, path, method=method, json=sub_request.get('body'), headers=headers,
+        )
+        responses.append({
+            'status': response.status_code,
+            'body': response.get_json() if response.is_json else response.get_data(as_text=True),
+        })
+    return {'responses': responses}
+
+
+@bp.get('/users/<string:user>/')
 @authenticated_moira
 def get_user(moira_query, user, kerb):
-    print(f"get_user({moira_query=}, {user=}, {kerb=})")
-
     if user == 'me':
         user = kerb
     
     res = moira_query('get_user_by_login', user)
     assert len(res) == 1
-    res = res[0]
+    return parse_user(res[0], kerb)
 
-    if res['middle']:
-        full_name = f"{res['first']} {res['middle']} {res['last']}"
-    else:
-        full_name = f"{res['first']} {res['last']}"
 
-    return {
-        'full_name': full_name,
-        'names': {
-            'first': res['first'],
-            'middle': res['middle'],
-            'last': res['last'],
-        },
-        'kerb': kerb,
-        'mit_id': res['clearid'],
-        'class_year': res['class'],
-    }
-
-
-@app.get('/users/<string:user>/belongings')
+@bp.get('/users/<string:user>/belongings')
 @authenticated_moira
 @jsoned
 def get_user_belongings(moira_query, user, kerb):
@@ -103,7 +216,7 @@ def get_user_belongings(moira_query, user, kerb):
     return get_ace_use(conditional_recursive_type('USER', recurse), user)
 
 
-@app.get('/users/<string:user>/lists')
+@bp.get('/users/<string:user>/lists')
 @authenticated_moira
 @jsoned
 def get_user_lists(moira_query, user, kerb):
@@ -111,14 +224,19 @@ def get_user_lists(moira_query, user, kerb):
         user = kerb
     include_properties = parse_bool(request.args.get('include_properties', False))
     recurse = parse_bool(request.args.get('recurse', True))
+    expand = request.args.getlist('expand')
+    tree = parse_expand(expand, 'list') if expand else None
     res = moira_query('get_lists_of_member', conditional_recursive_type('USER', recurse), user)
     if include_properties:
-        return [parse_list_dict(entry) for entry in res]
+        lists = [parse_list_dict(entry) for entry in res]
     else:
-        return [entry['list_name'] for entry in res]
+        lists = [entry['list_name'] for entry in res]
+    if tree:
+        return expand_lists(Loader(moira_query), lists, tree)
+    return lists
 
 
-@app.get('/users/<string:user>/tapaccess')
+@bp.get('/users/<string:user>/tapaccess')
 @authenticated_moira
 @jsoned
 def user_tap_access(moira_query, user, kerb):
@@ -128,7 +246,7 @@ def user_tap_access(moira_query, user, kerb):
     return [entry['list_name'] for entry in res]
 
 
-@app.get('/users/<string:user>/finger')
+@bp.get('/users/<string:user>/finger')
 @authenticated_moira
 def user_get_finger(moira_query, user, kerb):
     if user == 'me':
@@ -136,7 +254,7 @@ def user_get_finger(moira_query, user, kerb):
     return moira_query('get_finger_by_login', user)[0]
 
 
-@app.patch('/users/<string:user>/finger')
+@bp.patch('/users/<string:user>/finger')
 @authenticated_moira
 def user_change_finger(moira_query, user, kerb):
     if user == 'me':
@@ -169,7 +287,7 @@ def user_change_finger(moira_query, user, kerb):
     return 'success'
 
 
-@app.get('/lists/')
+@bp.get('/lists/')
 @authenticated_moira
 @jsoned
 def get_all_lists(moira_query, kerb):
@@ -177,16 +295,83 @@ def get_all_lists(moira_query, kerb):
         return {
             'description': 'You must set confirm to true to run this query.',
         }, 400
-    active = request.args.get('active', 'true')
-    public = request.args.get('public', 'true')
-    hidden = request.args.get('hidden', 'false')
-    maillist = request.args.get('is_mailing_list', 'true')
-    group = request.args.get('is_afs_group', 'dontcare')
-    res = moira_query('qualified_get_lists', active.upper(), public.upper(), hidden.upper(), maillist.upper(), group.upper())
+    res = moira_query('qualified_get_lists', *parse_list_filters(request.args))
     return [entry['list'] for entry in res]
 
 
-@app.post('/lists/<string:list_name>/')
+MAX_SEARCH_LIMIT = 100
+
+@bp.get('/lists/search')
+@authenticated_moira
+def search_lists(moira_query, kerb):
+    q = request.args.get('q', '')
+    try:
+        limit = min(int(request.args.get('limit', 20)), MAX_SEARCH_LIMIT)
+    except ValueError:
+        return {'description': 'limit must be an integer'}, 400
+    substring = parse_bool(request.args.get('substring', True))
+    filters = parse_list_filters(request.args)
+
+    if not shareable(filters) or not query_cache.authenticated():
+        # Only admins can see these lists, or we don't know yet whether Moira
+        # accepts this credential, so don't use (or build) the shared index
+        res = moira_query('qualified_get_lists', *filters)
+        return search([entry['list'] for entry in res], q, limit, substring)
+
+    # The index may be refreshed in the background after this request
+    # is over, so it can't rely on this request's ccache
+    cred = g.webathena_cred
+    def load_names():
+        res = moira_query_cred(cred, CLIENT_NAME, 'qualified_get_lists', *filters)
+        return [entry['list'] for entry in res]
+
+    return get_list_index(filters, load_names).search(q, limit, substring)
+
+
+@bp.post('/lists/_setops')
+@authenticated_moira
+def list_set_operations(moira_query, kerb):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    try:
+        recurse = setops.parse_flag('recurse', body.get('recurse', False))
+        count_only = setops.parse_flag('count_only', body.get('count_only', False))
+        stream = setops.parse_flag('stream', body.get('stream', False))
+        expression = setops.parse_expression(body.get('expression'), recurse)
+        result, members = setops.evaluate(moira_query, expression)
+    except ValueError as e:
+        return {'name': 'INVALID_EXPRESSION', 'description': str(e)}, 400
+
+    if count_only:
+        return setops.to_counts(result, members)
+    if stream:
+        return Response(setops.to_lines(result, members), mimetype='application/x-ndjson')
+    return setops.to_buckets(result, members)
+
+
+MAX_WATCHED_LISTS = 50
+
+def watch_response(moira_query, list_names):
+    subscriber = list_watch.subscribe(moira_query, g.webathena_cred, list_names)
+    return Response(
+        list_watch.stream(subscriber),
+        mimetype='text/event-stream',
+        # Don't let proxies buffer the events
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@bp.get('/lists/watch')
+@authenticated_moira
+def watch_lists(moira_query, kerb):
+    list_names = list(dict.fromkeys(request.args.getlist('list')))
+    if not list_names or len(list_names) > MAX_WATCHED_LISTS:
+        return {'description': f'You must give between 1 and {MAX_WATCHED_LISTS} lists'}, 400
+    return watch_response(moira_query, list_names)
+
+
+@bp.post('/lists/<string:list_name>/')
 @authenticated_moira
 def make_list(moira_query, list_name, kerb):
     # TODO: figure this out
@@ -194,39 +379,16 @@ def make_list(moira_query, list_name, kerb):
     return {'description': 'Not implemented'}, 401
 
 
-@app.get('/lists/<string:list_name>/')
+@bp.get('/lists/<string:list_name>/')
 @authenticated_moira
 def get_list(moira_query, list_name, kerb):
-    res = moira_query('get_list_info', list_name)[0]
-    return {
-        'name': res['name'],
-        'description': res['description'],
-        'active': parse_bool(res['active']),
-        'public': parse_bool(res['publicflg']),
-        'hidden': parse_bool(res['hidden']),
-        'is_mailing_list': parse_bool(res['maillist']),
-        'is_afs_group': parse_bool(res['grouplist']),
-        'is_nfs_group': parse_bool(res['nfsgroup']),
-        'is_physical_access': parse_bool(res['pacslist']),
-        'is_mailman_list': parse_bool(res['mailman']),
-        'owner': {
-            'type': res['ace_type'].lower(),
-            'name': res['ace_name'],
-        },
-        'membership_administrator': None if res['memace_type'] == 'NONE' else {
-            'type': res['memace_type'].lower(),
-            'name': res['memace_name'],
-        },
-        'last_modified': {
-            'time': res['modtime'],
-            'user': res['modby'],
-            'tool': res['modwith'],
-        },
-    }
+    res = query_cache.get_list_info(moira_query, list_name)
+    return parse_list_info(res)
 
 
-@app.patch('/lists/<string:list_name>/')
+@bp.patch('/lists/<string:list_name>/')
 @authenticated_moira
+@allow_async
 @plaintext
 def update_list(moira_query, list_name, kerb):
     current_attributes = moira_query('get_list_info', list_name)[0]
@@ -273,7 +435,7 @@ def update_list(moira_query, list_name, kerb):
     return 'success'
 
 
-@app.delete('/lists/<string:list_name>/')
+@bp.delete('/lists/<string:list_name>/')
 @authenticated_moira
 @plaintext
 def delete_list(moira_query, list_name, kerb):
@@ -281,36 +443,28 @@ def delete_list(moira_query, list_name, kerb):
     return 'success'
 
 
-@app.get('/lists/<string:list_name>/members/')
+@bp.get('/lists/<string:list_name>/members/')
 @authenticated_moira
 def get_list_members(moira_query, list_name, kerb):
     recurse = parse_bool(request.args.get('recurse', False))
     query = 'get_end_members_of_list' if recurse else 'get_members_of_list'
+    expand = request.args.getlist('expand')
+    tree = parse_expand(expand, 'members') if expand else None
     res = moira_query(query, list_name)
-    members = {
-        'users': [],
-        'lists': [],
-        'emails': [],
-        'kerberos': [],
-    }
-    for member in res:
-        name = member['member_name']
-        member_type = member['member_type']
-        if member_type == 'USER':
-            members['users'].append(name)
-        elif member_type == 'LIST':
-            members['lists'].append(name)
-        elif member_type == 'STRING':
-            members['emails'].append(name)
-        elif member_type == 'KERBEROS':
-            members['kerberos'].append(name)
-        else:
-            raise Exception(f'unrecognized member type {member_type}')
-    return members
+    if tree:
+        return expand_members(Loader(moira_query), parse_members(res), tree)
+    return parse_members(res)
 
 
-@app.put('/lists/<string:list_name>/members/<string:member_name>')
+@bp.get('/lists/<string:list_name>/watch')
 @authenticated_moira
+def watch_list(moira_query, list_name, kerb):
+    return watch_response(moira_query, [list_name])
+
+
+@bp.put('/lists/<string:list_name>/members/<string:member_name>')
+@authenticated_moira
+@allow_async
 def add_member(moira_query, list_name, member_name, kerb):
     if member_name == 'me':
         member_name = kerb
@@ -319,8 +473,9 @@ def add_member(moira_query, list_name, member_name, kerb):
     return Response('success', status=201, mimetype='text/plain')
 
 
-@app.delete('/lists/<string:list_name>/members/<string:member_name>')
+@bp.delete('/lists/<string:list_name>/members/<string:member_name>')
 @authenticated_moira
+@allow_async
 @plaintext
 def remove_member(moira_query, list_name, member_name, kerb):
     if member_name == 'me':
@@ -330,7 +485,7 @@ def remove_member(moira_query, list_name, member_name, kerb):
     return 'success'
 
 
-@app.get('/lists/<string:list_name>/belongings')
+@bp.get('/lists/<string:list_name>/belongings')
 @authenticated_moira
 @jsoned
 def get_list_belongings(moira_query, list_name, kerb):
@@ -338,44 +493,50 @@ def get_list_belongings(moira_query, list_name, kerb):
     return get_ace_use(conditional_recursive_type('LIST', recurse), list_name)
 
 
-@app.get('/lists/<string:list_name>/lists')
+@bp.get('/lists/<string:list_name>/lists')
 @authenticated_moira
 @jsoned
 def get_list_lists(moira_query, list_name, kerb):
     include_properties = parse_bool(request.args.get('include_properties', False))
     recurse = parse_bool(request.args.get('recurse', True))
+    expand = request.args.getlist('expand')
+    tree = parse_expand(expand, 'list') if expand else None
     res = moira_query('get_lists_of_member', conditional_recursive_type('LIST', recurse), list_name)
     if include_properties:
-        return [parse_list_dict(entry) for entry in res]
+        lists = [parse_list_dict(entry) for entry in res]
     else:
-        return [entry['list_name'] for entry in res]
+        lists = [entry['list_name'] for entry in res]
+    if tree:
+        return expand_lists(Loader(moira_query), lists, tree)
+    return lists
 
 
-@app.get('/lists/<string:list_name>/owner')
+@bp.get('/lists/<string:list_name>/owner')
 @authenticated_moira
 def get_list_admin(moira_query, list_name, kerb):
-    res = moira_query('get_list_info', list_name)[0]
+    res = query_cache.get_list_info(moira_query, list_name)
     return {
         'type': res['ace_type'].lower(),
         'name': res['ace_name'],
     }
 
 
-@app.put('/lists/<string:list_name>/owner')
+@bp.put('/lists/<string:list_name>/owner')
 @authenticated_moira
+@allow_async
 @plaintext
 def set_list_admin(moira_query, list_name, kerb):
-    attributes = create_update_list_input(list_name)
+    attributes = create_update_list_input(moira_query, list_name)
     attributes['ace_type'] = request.json['type'].upper()
     attributes['ace_name'] = request.json['name']
     moira_query('update_list', **attributes)
     return 'success'
 
 
-@app.get('/lists/<string:list_name>/membership_admin')
+@bp.get('/lists/<string:list_name>/membership_admin')
 @authenticated_moira
 def get_list_membership_admin(moira_query, list_name, kerb):
-    res = moira_query('get_list_info', list_name)[0]
+    res = query_cache.get_list_info(moira_query, list_name)
     if res['memace_type'] == 'NONE':
         return {
             'type': 'none',
@@ -385,34 +546,52 @@ def get_list_membership_admin(moira_query, list_name, kerb):
         'name': res['memace_name'],
     }
 
-@app.put('/lists/<string:list_name>/membership_admin')
+@bp.put('/lists/<string:list_name>/membership_admin')
 @authenticated_moira
+@allow_async
 @plaintext
 def set_list_membership_admin(moira_query, list_name, kerb):
-    attributes = create_update_list_input(list_name)
+    attributes = create_update_list_input(moira_query, list_name)
     attributes['memace_type'] = request.json['type'].upper()
     attributes['memace_name'] = request.json['name']
     moira_query('update_list', **attributes)
     return 'success'
 
 
-@app.delete('/lists/<string:list_name>/membership_admin')
+@bp.delete('/lists/<string:list_name>/membership_admin')
 @authenticated_moira
+@allow_async
 @plaintext
 def delete_list_membership_admin(moira_query, list_name, kerb):
-    attributes = create_update_list_input(list_name)
+    attributes = create_update_list_input(moira_query, list_name)
     attributes['memace_type'] = 'NONE'
     attributes['memace_name'] = 'NONE'
     moira_query('update_list', **attributes)
     return 'success'
 
 
-@app.post('/mailman/<string:list_name>/request_subscription')
+@bp.get('/jobs/<string:job_id>')
+@webathena
+def get_job(job_id, kerb):
+    job = jobs.get_job(job_id, kerb) if os.path.exists(jobs.JOBS_DB) else None
+    if job is None:
+        return {'name': 'JOB_NOT_FOUND', 'description': f'There is no job {job_id}'}, 404
+    return job
+
+
+@bp.post('/mailman/<string:list_name>/request_subscription')
 @webathena
 def request_mailman_subscription(list_name, kerb):
+    from mailman import mailman_request_subscription
     try:
         mailman_request_subscription(kerb, list_name)
         return "success"
+    except deadlines.DeadlineExceeded as e:
+        return {
+            'code': None,
+            'name': 'TIMEOUT',
+            'message': str(e),
+        }, 504
     except OSError as e:
         # Emulate the structure of Moira errors to allow reusing existing code
         return {
@@ -422,12 +601,19 @@ def request_mailman_subscription(list_name, kerb):
         }, 500
 
 
-@app.post('/mailman/<string:list_name>/request_unsubscription')
+@bp.post('/mailman/<string:list_name>/request_unsubscription')
 @webathena
 def request_mailman_unsubscription(list_name, kerb):
+    from mailman import mailman_request_unsubscription
     try:
         mailman_request_unsubscription(kerb, list_name)
         return "success"
+    except deadlines.DeadlineExceeded as e:
+        return {
+            'code': None,
+            'name': 'TIMEOUT',
+            'message': str(e),
+        }, 504
     except OSError as e:
         # Emulate the structure of Moira errors to allow reusing existing code
         return {
@@ -437,13 +623,86 @@ def request_mailman_unsubscription(list_name, kerb):
         }, 500
 
 
-app.debug = True
+
+# Settings for create_app. Any of them can be overridden by passing a dict to it.
+CONFIG_PROFILES = {
+    'production': {
+        'DEBUG': False,
+        # to actually use the API from JavaScript
+        'CORS': True,
+        # Number of proxies in front of the app (see ProxyFix), or 0 if there are none
+        'PROXY_COUNT': 1,
+        # Where to log the timings of each request (see timing), besides the
+        # handlers of the root logger: 'stdout', 'stderr' or None
+        'REQUEST_LOG': 'stdout',
+    },
+    'development': {
+        # Also lets you use your own tickets instead of webathena (see decorators.webathena)
+        'DEBUG': True,
+        'CORS': True,
+        'PROXY_COUNT': 0,
+        'REQUEST_LOG': 'stdout',
+    },
+}
+
+
+def create_app(config=None):
+    """
+    Makes the Flask app.
+
+    `config` may be the name of a profile in CONFIG_PROFILES, or a dict of settings
+    (which override the production profile). If it is not given, the profile is taken
+    from the MOIRA_API_PROFILE environment variable (by default, production).
+
+    Heavy modules (moira, flask_cors, mailman) are only imported when needed,
+    so that workers start quickly.
+    """
+    if config is None:
+        config = os.environ.get('MOIRA_API_PROFILE', 'production')
+    if isinstance(config, str):
+        config = CONFIG_PROFILES[config]
+    else:
+        config = {**CONFIG_PROFILES['production'], **config}
+
+    app = Flask(__name__)
+    app.config.update(config)
+    app.register_blueprint(bp)
+    profiling.init_app(app)
+    if app.config['REQUEST_LOG']:
+        stream = {'stdout': sys.stdout, 'stderr': sys.stderr}[app.config['REQUEST_LOG']]
+        timing.logger.setLevel(logging.INFO)
+        # Only once, even if several apps are made
+        if not any(getattr(handler, 'stream', None) is stream for handler in timing.logger.handlers):
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            timing.logger.addHandler(handler)
+    if app.config['CORS']:
+        from flask_cors import CORS
+        CORS(app)
+    if app.config['PROXY_COUNT']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        proxies = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies, x_prefix=proxies
+        )
+    return app
+
+
+_app = None
+
+def __getattr__(name):
+    """
+    Makes `api.app` (e.g. for `gunicorn api:app`) with the default config
+    the first time it is used
+    """
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
-    # app.run(host="0.0.0.0", port=8000)
-    app.debug = True
-    app.run()
-else:
-    from werkzeug.middleware.proxy_fix import ProxyFix
-    app.wsgi_app = ProxyFix(
-        app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1
-    )
+    # create_app('development').run(host="0.0.0.0", port=8000)
+    create_app('development').run()
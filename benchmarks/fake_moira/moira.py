@@ -0,0 +1,116 @@
+"""
+Fake moira module for load testing (see benchmarks/loadgen.py), which
+answers the queries the API makes with made-up data after a configurable
+delay, instead of talking to a Moira server.
+
+It is only used when benchmarks/fake_moira is put first in PYTHONPATH.
+
+Settings (environment variables):
+
+* FAKE_MOIRA_LATENCY_MS: time each query takes (default 20)
+* FAKE_MOIRA_CONNECT_MS: time connect() and auth() take (default 5)
+
+Like Moira with tickets it can't decrypt, auth() turns down credential
+caches with FORGED_TICKET in them (see benchmarks/isolation_check.py).
+"""
+
+import os
+import time
+
+_LATENCY = float(os.environ.get('FAKE_MOIRA_LATENCY_MS', 20)) / 1000
+_CONNECT_LATENCY = float(os.environ.get('FAKE_MOIRA_CONNECT_MS', 5)) / 1000
+
+FORGED_TICKET = b'FORGED TICKET'
+
+_ERRORS = {
+    'MR_PERM': 47836460,
+    'MR_NO_MATCH': 47836421,
+    'MR_EXISTS': 47836427,
+    'MR_IN_USE': 47836433,
+    'MR_ARGS': 47836417,
+}
+
+
+class MoiraException(Exception):
+    @property
+    def code(self):
+        return self.args[0]
+
+
+def errors():
+    return dict(_ERRORS)
+
+
+def connect(server=''):
+    time.sleep(_CONNECT_LATENCY)
+
+
+def auth(program):
+    time.sleep(_CONNECT_LATENCY)
+    ccache = os.environ.get('KRB5CCNAME', '').removeprefix('FILE:')
+    if ccache:
+        with open(ccache, 'rb') as f:
+            if FORGED_TICKET in f.read():
+                raise MoiraException(_ERRORS['MR_PERM'], b'Authentication failed')
+
+
+def disconnect():
+    pass
+
+
+def _list_info(name):
+    return {
+        'name': name, 'active': '1', 'publicflg': '1', 'hidden': '0', 'maillist': '1',
+        'grouplist': '0', 'gid': '-1', 'nfsgroup': '0', 'mailman': '0',
+        'mailman_server': '[NONE]', 'ace_type': 'USER', 'ace_name': 'owner',
+        'memace_type': 'NONE', 'memace_name': 'NONE', 'description': f'The {name} list',
+        'modtime': '01-jan-2024 00:00:00', 'modby': 'owner', 'modwith': 'python3',
+        'pacslist': '0',
+    }
+
+
+def _list_entry(name):
+    return {
+        'list_name': name, 'active': '1', 'publicflg': '1', 'hidden': '0',
+        'maillist': '1', 'grouplist': '0',
+    }
+
+
+def _members(name):
+    # Deterministic, somewhat varied list sizes
+    size = 5 + sum(name.encode()) % 200
+    members = [{'member_type': 'USER', 'member_name': f'user{i}'} for i in range(size)]
+    members += [{'member_type': 'STRING', 'member_name': f'someone{i}@example.com'} for i in range(size // 10)]
+    members += [{'member_type': 'LIST', 'member_name': f'{name}-sub{i}'} for i in range(size // 50)]
+    return members
+
+
+def _user(login):
+    return {
+        'login': login, 'first': 'Load', 'middle': '', 'last': 'Test', 'clearid': '900000000',
+        'class': 'G', 'status': '1',
+    }
+
+
+_QUERIES = {
+    'get_list_info': lambda name: [_list_info(name)],
+    'get_members_of_list': _members,
+    'get_end_members_of_list': lambda name: [m for m in _members(name) if m['member_type'] != 'LIST'],
+    'get_lists_of_member': lambda member_type, name: [_list_entry(f'list{i}') for i in range(30)],
+    'get_user_by_login': lambda login: [_user(login)],
+    'get_finger_by_login': lambda login: [{'login': login, 'fullname': 'Load Test'}],
+    'qualified_get_lists': lambda *filters: [{'list': f'list{i}'} for i in range(20000)],
+    'get_ace_use': lambda ace_type, name: [{'use_type': 'LIST', 'use_name': 'list1'}],
+    'get_machine': lambda name: [{'name': name.upper(), 'type': 'LINUX', 'owner_type': 'USER', 'owner_name': 'owner'}],
+    'add_member_to_list': lambda *args: [],
+    'delete_member_from_list': lambda *args: [],
+    'update_list': lambda *args: [],
+}
+
+
+def query(*args, **kwargs):
+    time.sleep(_LATENCY)
+    name, args = args[0], args[1:]
+    if name not in _QUERIES:
+        raise MoiraException(_ERRORS['MR_NO_MATCH'], b'No such query')
+    return _QUERIES[name](*args, *kwargs.values())
@@ -0,0 +1,132 @@
+"""
+Regression check that cached and indexed results don't leak between
+callers, run against a fake Moira (see benchmarks/fake_moira) that turns
+down forged tickets:
+
+* a forged token claiming to be someone else must never be served that
+  person's cached results (X-Cache must be MISS or BYPASS, never HIT),
+  whether they are cached per credential or for everyone
+* list searches whose filters only admins may use (hidden or inactive
+  lists), or made with a credential Moira hasn't accepted yet, must never
+  reach the shared list index (list_search.get_list_index)
+
+It exits with status 1 if any check fails. Set MOIRA_CACHE_BACKEND to check
+another cache backend.
+
+Usage (from the repository root):
+
+    python benchmarks/isolation_check.py
+"""
+
+import base64
+import json
+import os
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCHMARKS, 'fake_moira'), os.path.join(BENCHMARKS, '..')]
+os.environ.setdefault('FAKE_MOIRA_LATENCY_MS', '1')
+os.environ.setdefault('FAKE_MOIRA_CONNECT_MS', '0')
+
+import api
+import moira
+from list_search import shareable
+from loadgen import webathena_token
+
+# Paths whose results are cached, per credential or for everyone (see query_cache)
+CACHED_PATHS = [
+    '/raw_query/get_user_by_login?arg=victim',
+    '/raw_query/get_list_info?arg=victims-list',
+    '/raw_query/get_machine?arg=victims-machine',
+    '/lists/victims-list/',
+]
+
+# Query strings of list searches, with the filters they use
+SEARCHES = [
+    '',
+    'hidden=true',
+    'hidden=dontcare',
+    'active=false',
+    'active=dontcare',
+    'active=false&hidden=true',
+    'public=false',
+]
+
+
+def token(kerb, forged=False):
+    """
+    A webathena token for the given kerb, which the fake Moira turns down if forged
+    """
+    cred = json.loads(base64.b64decode(webathena_token(0)))
+    cred['cname']['nameString'] = [kerb]
+    if forged:
+        cipher = moira.FORGED_TICKET * 20
+        cred['ticket']['encPart']['cipher'] = base64.b64encode(cipher).decode()
+    return base64.b64encode(json.dumps(cred).encode()).decode()
+
+
+def auth(kerb, forged=False):
+    return {'Authorization': f'webathena {token(kerb, forged)}'}
+
+
+def check_forged_tokens(client):
+    ok = True
+    victim = auth('victim')
+    for path in CACHED_PATHS:
+        # Twice, so that the victim's result is in the cache
+        for _ in range(2):
+            response = client.get(path, headers=victim)
+            if response.status_code != 200:
+                print(f'FAILED {path}: {response.status_code} for the victim')
+                return False
+        response = client.get(path, headers=auth('victim', forged=True))
+        cache_status = response.headers.get('X-Cache', 'MISS')
+        if response.status_code == 200 or cache_status not in ('MISS', 'BYPASS'):
+            print(f'FAILED {path}: forged token got {response.status_code} (X-Cache: {cache_status})')
+            ok = False
+    print(f'{len(CACHED_PATHS)} cached paths with forged tokens: {"ok" if ok else "FAILED"}')
+    return ok
+
+
+def check_list_index(client):
+    used = []
+    get_list_index = api.get_list_index
+
+    def recording_get_list_index(filters, load_names):
+        used.append(filters)
+        return get_list_index(filters, load_names)
+
+    api.get_list_index = recording_get_list_index
+    try:
+        ok = True
+        accepted = auth('searcher')
+        # Let Moira accept it first
+        client.get('/users/me/', headers=accepted)
+        for headers in (accepted, auth('searcher', forged=True)):
+            for search in SEARCHES:
+                used.clear()
+                forged = headers is not accepted
+                client.get(f'/lists/search?q=list1&{search}', headers=headers)
+                leaked = [filters for filters in used if forged or not shareable(filters)]
+                if leaked:
+                    print(f'FAILED search {search!r} ({"forged" if forged else "accepted"} token) used the index for {leaked}')
+                    ok = False
+                elif not forged and not search and not used:
+                    # Otherwise this would check nothing
+                    print('FAILED a search with the default filters did not use the index')
+                    ok = False
+    finally:
+        api.get_list_index = get_list_index
+    print(f'{len(SEARCHES) * 2} list searches: {"ok" if ok else "FAILED"}')
+    return ok
+
+
+def main():
+    client = api.create_app({'CORS': False, 'PROXY_COUNT': 0, 'REQUEST_LOG': None}).test_client()
+    results = [check_forged_tokens(client), check_list_index(client)]
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
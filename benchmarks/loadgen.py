@@ -0,0 +1,323 @@
+"""
+Load generator that replays a trace of API requests against the app
+(running on a fake Moira, see benchmarks/fake_moira) at several
+concurrency levels and with several server modes, to catch scaling
+regressions that micro-benchmarks miss.
+
+The trace is either synthetic (a weighted mix of typical requests made
+by many different users, see MIX) or read from a file with one JSON
+object per line:
+
+    {"method": "GET", "path": "/users/me/lists", "user": 3}
+
+where "user" picks which webathena token to send (each user gets their own).
+
+Server modes are gunicorn worker classes (so gunicorn, and gevent for
+"gevent", must be installed):
+
+* sync: --workers sync worker processes
+* gthread: --workers processes with --threads threads each
+* gevent: --workers async (gevent) workers
+
+For each mode and concurrency level, it reports throughput, latency
+percentiles, error rate and the peak memory (RSS) of all the server's
+processes, as a table and optionally as JSON (--json).
+
+Usage (from the repository root):
+
+    python benchmarks/loadgen.py [--modes sync,gthread] [--concurrency 1,8,32]
+        [--duration 10] [--latency-ms 20] [--trace FILE] [--json FILE]
+
+or, against a server that is already running (with whatever Moira it uses):
+
+    python benchmarks/loadgen.py --url http://localhost:8000 [...]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FAKE_MOIRA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_moira')
+
+# (weight, method, path) of the synthetic trace. {list} and {member} are
+# replaced by random names.
+MIX = [
+    (30, 'GET', '/users/me/lists'),
+    (30, 'GET', '/lists/{list}/members/'),
+    (10, 'PUT', '/lists/{list}/members/{member}'),
+    (10, 'GET', '/status'),
+    (20, 'GET', '/raw_query/get_list_info?arg={list}'),
+]
+
+MODES = {
+    'sync': lambda args: ['-k', 'sync', '-w', str(args.workers)],
+    'gthread': lambda args: ['-k', 'gthread', '-w', str(args.workers), '--threads', str(args.threads)],
+    'gevent': lambda args: ['-k', 'gevent', '-w', str(args.workers)],
+}
+
+
+def webathena_token(user):
+    """
+    A made-up (but well-formed) webathena credential for the given user number
+    """
+    key = base64.b64encode(bytes(32)).decode()
+    cred = {
+        'cname': {'nameType': 1, 'nameString': [f'loaduser{user}']},
+        'crealm': 'ATHENA.MIT.EDU',
+        'sname': {'nameType': 2, 'nameString': ['moira', 'moira.mit.edu']},
+        'srealm': 'ATHENA.MIT.EDU',
+        'key': {'keytype': 18, 'keyvalue': key},
+        'authtime': 1700000000000,
+        'endtime': 1700036000000,
+        'flags': [False] * 32,
+        'ticket': {
+            'realm': 'ATHENA.MIT.EDU',
+            'sname': {'nameType': 2, 'nameString': ['moira', 'moira.mit.edu']},
+            'encPart': {'etype': 18, 'kvno': 1, 'cipher': base64.b64encode(bytes(300)).decode()},
+        },
+    }
+    return base64.b64encode(json.dumps(cred).encode()).decode()
+
+
+def synthetic_trace(length, users, seed):
+    rng = random.Random(seed)
+    weights = [weight for weight, _, _ in MIX]
+    trace = []
+    for _ in range(length):
+        _, method, path = rng.choices(MIX, weights)[0]
+        path = path.format(list=f'list{rng.randrange(500)}', member=f'user{rng.randrange(5000)}')
+        trace.append({'method': method, 'path': path, 'user': rng.randrange(users)})
+    return trace
+
+
+def read_trace(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+class RssSampler(threading.Thread):
+    """
+    Keeps track of the peak total RSS of a process and its descendants (Linux only)
+    """
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def _descendants(self, pid):
+        pids = [pid]
+        try:
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    for child in f.read().split():
+                        pids += self._descendants(int(child))
+        except OSError:
+            pass
+        return pids
+
+    def _rss(self, pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def run(self):
+        while not self.stopped.wait(0.1):
+            self.peak = max(self.peak, sum(self._rss(pid) for pid in self._descendants(self.pid)))
+
+
+def run_level(url, trace, tokens, concurrency, duration):
+    """
+    Replays the trace (cycling through it) with the given number of
+    concurrent clients for `duration` seconds
+    """
+    parsed = urllib.parse.urlsplit(url)
+    next_request = 0
+    lock = threading.Lock()
+    results = []
+    deadline = time.perf_counter() + duration
+
+    def client():
+        nonlocal next_request
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=60)
+        local_results = []
+        while time.perf_counter() < deadline:
+            with lock:
+                request = trace[next_request % len(trace)]
+                next_request += 1
+            headers = {'Authorization': f'webathena {tokens[request.get("user", 0) % len(tokens)]}'}
+            start = time.perf_counter()
+            try:
+                connection.request(request['method'], request['path'], headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                connection.close()
+                connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=60)
+            local_results.append((time.perf_counter() - start, status))
+        connection.close()
+        with lock:
+            results.extend(local_results)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    statuses = Counter(status for _, status in results)
+    errors = sum(count for status, count in statuses.items() if not 200 <= status < 300)
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'throughput_rps': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else 0.0,
+        'error_rate': errors / len(results) if results else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, args):
+    port = free_port()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([FAKE_MOIRA, ROOT, env.get('PYTHONPATH', '')])
+    env['PATH'] = os.pathsep.join([os.path.join(FAKE_MOIRA, 'bin'), env['PATH']])
+    env['FAKE_MOIRA_LATENCY_MS'] = str(args.latency_ms)
+    env['MOIRA_API_PROFILE'] = 'production'
+    command = [
+        sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}',
+        *MODES[mode](args), 'api:app',
+    ]
+    server = subprocess.Popen(command, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'{mode} server exited with code {server.returncode} (is gunicorn installed?)')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            return server, url
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def print_table(rows):
+    print(f'{"mode":<8} {"conc":>5} {"reqs":>7} {"req/s":>8} {"p50 ms":>8} {"p90 ms":>8} '
+          f'{"p99 ms":>8} {"max ms":>8} {"errors":>7} {"peak RSS MiB":>13}')
+    for row in rows:
+        rss = f'{row["peak_rss_bytes"] / 2**20:.1f}' if row.get('peak_rss_bytes') else '-'
+        print(f'{row["mode"]:<8} {row["concurrency"]:>5} {row["requests"]:>7} {row["throughput_rps"]:>8.1f} '
+              f'{row["p50_ms"]:>8.1f} {row["p90_ms"]:>8.1f} {row["p99_ms"]:>8.1f} {row["max_ms"]:>8.1f} '
+              f'{row["error_rate"]:>7.1%} {rss:>13}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='run against this server instead of starting one')
+    parser.add_argument('--modes', default='sync,gthread', help='comma-separated server modes (%(default)s)')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='comma-separated concurrency levels (%(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per level (%(default)s)')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of warm-up per server (%(default)s)')
+    parser.add_argument('--workers', type=int, default=4, help='server worker processes (%(default)s)')
+    parser.add_argument('--threads', type=int, default=16, help='threads per gthread worker (%(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='fake Moira query latency (%(default)s)')
+    parser.add_argument('--trace', help='JSON lines trace file (default: synthetic)')
+    parser.add_argument('--users', type=int, default=200, help='distinct users in the synthetic trace (%(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic trace')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    trace = read_trace(args.trace) if args.trace else synthetic_trace(10000, args.users, args.seed)
+    users = max(request.get('user', 0) for request in trace) + 1
+    tokens = [webathena_token(user) for user in range(users)]
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    rows = []
+    modes = ['external'] if args.url else args.modes.split(',')
+    for mode in modes:
+        server = None
+        url = args.url
+        if not args.url:
+            server, url = start_server(mode, args)
+        sampler = RssSampler(server.pid) if server else None
+        try:
+            run_level(url, trace, tokens, max(levels), args.warmup)
+            for level in levels:
+                if sampler:
+                    sampler.peak = 0
+                    if not sampler.is_alive():
+                        sampler.start()
+                row = {'mode': mode, **run_level(url, trace, tokens, level, args.duration)}
+                if sampler:
+                    row['peak_rss_bytes'] = sampler.peak
+                rows.append(row)
+                print(f'{mode}, concurrency {level}: {row["throughput_rps"]:.1f} req/s', file=sys.stderr)
+        finally:
+            if sampler:
+                sampler.stopped.set()
+            if server:
+                stop_server(server)
+
+    print()
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Benchmark for make_ccache, which runs on every authenticated request.
+
+Before measuring anything, it checks make_ccache against golden vectors
+(SHA-256 of the ccache produced by the original webathena encoder for a
+set of credentials covering the DER edge cases), so an optimization
+can't silently change the output.
+
+Usage (from the repository root):
+
+    python benchmarks/make_ccache_bench.py [--check] [--seconds N]
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from make_ccache import make_ccache
+
+
+def _blob(n, seed):
+    """
+    Deterministic base64-encoded blob of n bytes
+    """
+    return base64.b64encode(bytes((i * 31 + seed) & 0xff for i in range(n))).decode()
+
+
+def credential(cipher_len=300, key_len=32, kvno=2, etype=18,
+               cname=('rgabriel',), realm='ATHENA.MIT.EDU', **extra):
+    cred = {
+        'cname': {'nameType': 1, 'nameString': list(cname)},
+        'crealm': realm,
+        'sname': {'nameType': 2, 'nameString': ['moira', 'moira.mit.edu']},
+        'srealm': realm,
+        'key': {'keytype': 18, 'keyvalue': _blob(key_len, 1)},
+        'authtime': 1700000000000,
+        'endtime': 1700036000000,
+        'flags': [False, True, False, True] + [False] * 28,
+        'ticket': {
+            'realm': realm,
+            'sname': {'nameType': 2, 'nameString': ['moira', 'moira.mit.edu']},
+            'encPart': {'etype': etype, 'cipher': _blob(cipher_len, 2)},
+        },
+    }
+    if kvno is not None:
+        cred['ticket']['encPart']['kvno'] = kvno
+    cred.update(extra)
+    return cred
+
+
+# name: (credential, SHA-256 of the expected ccache)
+GOLDEN_VECTORS = {
+    'typical': (credential(),
+        'bf9acce27fd2b185d559034512fbd7e0076f4ed180f052232a251d4b460c8250'),
+    'no_kvno': (credential(kvno=None),
+        'f2ec4879cf6229957733c7d7bd488a63d5e7f2edac6c794a267393de6b0bb8b7'),
+    # 0x00 0x80, not 0x80
+    'kvno_128': (credential(kvno=128),
+        '7ba6f1f267af9ae4fab0d79e5c5be30727b680e61fc2c9dea0d1d68d062d5550'),
+    'kvno_max': (credential(kvno=4294967295),
+        '263868794980539de3723295b3732f8f3e5e6e93def4c675b656d7f48614fd91'),
+    'etype_-1': (credential(etype=-1),
+        'de23c97362a2d9e222c1470abb374dc1ab31f155c365f9d724e0d1fa253c03ce'),
+    'etype_min': (credential(etype=-2147483648),
+        'cbef4524d4934b77ce4c5a6d527b558956629e3a93ab9878c6322cbac931aca6'),
+    'etype_255': (credential(etype=255),
+        '675eef4e40934e55898e0d1d57dc09f5816da7ee7a514d5cc63ab82645b22e3c'),
+    'etype_-256': (credential(etype=-256),
+        '5b77cbd931663f848893647b61696fa206da16db0c7f5bca6f2b48413dd153e2'),
+    'empty_cipher': (credential(cipher_len=0),
+        'e3d2546828f14240a35650c90086077f741d50fe79cc364e88b914c1a4448591'),
+    # DER lengths of 127 or less
+    'short_cipher': (credential(cipher_len=100),
+        '85dcff9a78252683a5be7e2592b2d9293bcc9405cada73922ff630cc3b43b893'),
+    # one byte DER lengths over 127
+    'medium_cipher': (credential(cipher_len=200),
+        '85e3847b1bed445929aaba042dd1cbaf05c258af62246f1232d8729692e65897'),
+    # three byte DER lengths
+    'long_cipher': (credential(cipher_len=70000),
+        'b3b603e6f9f366547a63d6a0b9db0d5c1f5bb5aed82ad56bf9f1aa04ab0b9c20'),
+    'multi_cname': (credential(cname=('rgabriel', 'root')),
+        '456f5e9cd3f96c9b040bf2066bdc02ce2c241fdb34867fa41d9bc6bbf674deaa'),
+    'unicode_realm': (credential(realm='ÅTHENA.MIT.EDU'),
+        'ce1b56f0b509f39e4390a80cdb39b4b1a7b4709f38c35b2780adb7ca1618416c'),
+    'all_times': (credential(starttime=1700000100000, renewTill=1700600000000),
+        'e33681933b78f17eaaa4e6f9d039e9b77a091917fd43f1486da92f39a9c3f682'),
+}
+
+
+def check():
+    ok = True
+    for name, (cred, expected) in GOLDEN_VECTORS.items():
+        actual = hashlib.sha256(make_ccache(cred)).hexdigest()
+        if actual != expected:
+            print(f'MISMATCH {name}: expected {expected}, got {actual}')
+            ok = False
+    print(f'{len(GOLDEN_VECTORS)} golden vectors: {"ok" if ok else "FAILED"}')
+    return ok
+
+
+def bench(cred, seconds):
+    # Calls per second
+    calls = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        for _ in range(100):
+            make_ccache(cred)
+        calls += 100
+    rate = calls / (time.perf_counter() - start)
+
+    # Memory allocated while encoding (peak, since buffers are freed right away),
+    # and how many blocks allocated by make_ccache.py a call leaves behind (the
+    # ccache, and anything kept around between calls)
+    make_ccache(cred)
+    tracemalloc.start()
+    only_make_ccache = [tracemalloc.Filter(True, sys.modules[make_ccache.__module__].__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(only_make_ccache)
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    ccache = make_ccache(cred)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces(only_make_ccache)
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return rate, peak - base, blocks, len(ccache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='only check the golden vectors')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent on each case')
+    args = parser.parse_args()
+
+    if not check():
+        sys.exit(1)
+    if args.check:
+        return
+
+    print(f'{"case":<16} {"creds/s":>10} {"ccache bytes":>13} {"peak alloc bytes":>17} {"alloc blocks":>13}')
+    for name, (cred, _) in GOLDEN_VECTORS.items():
+        rate, peak, blocks, size = bench(cred, args.seconds)
+        print(f'{name:<16} {rate:>10.0f} {size:>13} {peak:>17} {blocks:>13}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark for how long it takes to start the processes the API uses,
+and how much memory they take:
+
+* web: a web worker, which imports api and calls create_app()
+* moira worker: a Moira worker process (when not forked), which imports moira_worker
+* python: an empty Python interpreter, for reference
+
+Each case runs in a fresh interpreter several times, and the median is reported.
+Needs the API's dependencies (including moira) to be installed.
+
+Usage (from the repository root):
+
+    python benchmarks/startup_bench.py [--runs N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Code run in the child: does the import and prints how long it took and the peak RSS
+_CHILD = '''
+import json, resource, sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+# ru_maxrss is in KiB on Linux
+print(json.dumps({{
+    "import_ms": elapsed * 1000,
+    "rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+}}))
+'''
+
+CASES = {
+    'web': 'import api\napi.create_app()',
+    'moira worker': 'import moira_worker',
+    'python': 'pass',
+}
+
+
+def run_once(code):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', _CHILD.format(code=code)],
+        cwd=ROOT, check=True, stdout=subprocess.PIPE, encoding='utf-8',
+    ).stdout
+    result = json.loads(output)
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='runs per case')
+    args = parser.parse_args()
+
+    print(f'{"case":<14} {"import ms":>10} {"process ms":>11} {"RSS MiB":>8} {"modules":>8}')
+    for name, code in CASES.items():
+        runs = [run_once(code) for _ in range(args.runs)]
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f'{name:<14} {median["import_ms"]:>10.1f} {median["process_ms"]:>11.1f} '
+              f'{median["rss_mib"]:>8.1f} {median["modules"]:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Cache storage shared by everything that caches (credentials, list
+attributes, /raw_query results), so that it can be swapped for one that
+all worker processes share, instead of each of them caching on its own.
+
+Values are bytes, grouped in namespaces. Each namespace has its own TTL and
+maximum total size (of keys and values); when a namespace is full, the
+least recently used entries (memory) or the ones closest to expiring
+(SQLite) are dropped.
+
+The backend is picked with the MOIRA_CACHE_BACKEND environment variable:
+
+* memory (default): a dict in each process
+* sqlite:/path/to/file: a SQLite database, which all the processes on a
+  host can share. It holds Kerberos tickets, so it is only readable by
+  the user running the API.
+
+Other backends (e.g. a networked one) can be added by subclassing
+CacheBackend and adding them to BACKENDS.
+"""
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from sqlite_db import SQLiteDatabase
+
+BACKEND = os.environ.get('MOIRA_CACHE_BACKEND', 'memory')
+
+
+class CacheBackend:
+    """
+    Interface for cache storage. All methods must be thread-safe.
+    """
+
+    def get(self, namespace, key: str) -> bytes | None:
+        """
+        The value for the key, or None if it is missing or expired
+        """
+        raise NotImplementedError
+
+    def set(self, namespace, key: str, value: bytes, ttl, max_bytes):
+        """
+        Stores a value for `ttl` seconds, dropping other entries of the
+        namespace if needed so that it takes up at most `max_bytes`
+        """
+        raise NotImplementedError
+
+    def add(self, namespace, key: str, value: bytes, ttl, max_bytes) -> bytes:
+        """
+        Like set, but only if there is no value for the key yet.
+        Returns the value that ends up stored (this one or the existing one).
+        """
+        raise NotImplementedError
+
+    def clear(self, namespace):
+        """
+        Drops every entry of the namespace (in every process, if shared)
+        """
+        raise NotImplementedError
+
+    def usage(self, namespace):
+        """
+        Returns (number of entries, bytes used) of the namespace
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    LRU caches in the memory of this process
+    """
+
+    def __init__(self):
+        # Reentrant, for add
+        self._lock = threading.RLock()
+        # namespace -> key -> (expiry time, value)
+        self._entries: dict[str, OrderedDict] = {}
+        self._bytes = Counter()
+
+    def get(self, namespace, key):
+        with self._lock:
+            entries = self._entries.get(namespace)
+            entry = entries.get(key) if entries else None
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(namespace, key)
+                return None
+            entries.move_to_end(key)
+            return entry[1]
+
+    def _drop(self, namespace, key):
+        _, value = self._entries[namespace].pop(key)
+        self._bytes[namespace] -= len(key) + len(value)
+
+    def set(self, namespace, key, value, ttl, max_bytes):
+        size = len(key) + len(value)
+        if size > max_bytes:
+            return
+        with self._lock:
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            if key in entries:
+                self._drop(namespace, key)
+            entries[key] = (time.monotonic() + ttl, value)
+            self._bytes[namespace] += size
+            while self._bytes[namespace] > max_bytes:
+                self._drop(namespace, next(iter(entries)))
+
+    def add(self, namespace, key, value, ttl, max_bytes):
+        with self._lock:
+            current = self.get(namespace, key)
+            if current is not None:
+                return current
+            self.set(namespace, key, value, ttl, max_bytes)
+            return value
+
+    def clear(self, namespace):
+        with self._lock:
+            self._entries.pop(namespace, None)
+            self._bytes[namespace] = 0
+
+    def usage(self, namespace):
+        with self._lock:
+            return len(self._entries.get(namespace, ())), self._bytes[namespace]
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Cache in a SQLite database, shared by the processes that open the same file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Losing the cache on a power failure is fine
+        self._database = SQLiteDatabase(path, timeout=5, synchronous='OFF')
+        with self._database.transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            """)
+            # Covers the expiry and eviction queries
+            db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (namespace, expires, size)')
+            # Running totals of each namespace, so that writes don't have to add sizes up
+            if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'cache_usage'").fetchone() is None:
+                db.execute("""
+                    CREATE TABLE cache_usage (
+                        namespace TEXT PRIMARY KEY,
+                        entries INTEGER NOT NULL,
+                        size INTEGER NOT NULL
+                    )
+                """)
+                # In case the cache was made by a version without it
+                db.execute('INSERT INTO cache_usage SELECT namespace, COUNT(*), SUM(size) FROM cache GROUP BY namespace')
+
+    def get(self, namespace, key):
+        row = self._database.execute(
+            'SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires >= ?',
+            (namespace, key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _add_usage(self, db, namespace, entries, size):
+        """
+        Adds to the running totals of a namespace, and returns its new size
+        """
+        return db.execute(
+            """
+            INSERT INTO cache_usage VALUES (?, ?, ?)
+            ON CONFLICT (namespace) DO UPDATE SET entries = entries + excluded.entries, size = size + excluded.size
+            RETURNING size
+            """,
+            (namespace, entries, size),
+        ).fetchone()[0]
+
+    def _set(self, db, namespace, key, value, ttl, max_bytes):
+        now = time.time()
+        size = len(key) + len(value)
+        replaced = db.execute(
+            'SELECT size FROM cache WHERE namespace = ? AND key = ?', (namespace, key),
+        ).fetchone()
+        db.execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+            (namespace, key, value, size, now + ttl),
+        )
+        added_entries, added_size = (0, size - replaced[0]) if replaced else (1, size)
+        expired, expired_size = db.execute(
+            'SELECT COUNT(*), TOTAL(size) FROM cache WHERE namespace = ? AND expires < ?', (namespace, now),
+        ).fetchone()
+        if expired:
+            db.execute('DELETE FROM cache WHERE namespace = ? AND expires < ?', (namespace, now))
+        used = self._add_usage(db, namespace, added_entries - expired, added_size - int(expired_size))
+        if used > max_bytes:
+            # Drop the entries that would expire first until it fits
+            to_drop = []
+            dropped_size = 0
+            for old_key, old_size in db.execute(
+                'SELECT key, size FROM cache WHERE namespace = ? ORDER BY expires', (namespace,)
+            ):
+                if used - dropped_size <= max_bytes:
+                    break
+                to_drop.append((namespace, old_key))
+                dropped_size += old_size
+            db.executemany('DELETE FROM cache WHERE namespace = ? AND key = ?', to_drop)
+            self._add_usage(db, namespace, -len(to_drop), -dropped_size)
+
+    def set(self, namespace, key, value, ttl, max_bytes):
+        if len(key) + len(value) > max_bytes:
+            return
+        with self._database.transaction() as db:
+            self._set(db, namespace, key, value, ttl, max_bytes)
+
+    def add(self, namespace, key, value, ttl, max_bytes):
+        with self._database.transaction() as db:
+            row = db.execute(
+                'SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires >= ?',
+                (namespace, key, time.time()),
+            ).fetchone()
+            if row is not None:
+                return row[0]
+            if len(key) + len(value) <= max_bytes:
+                self._set(db, namespace, key, value, ttl, max_bytes)
+            return value
+
+    def clear(self, namespace):
+        with self._database.transaction() as db:
+            db.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+            db.execute('DELETE FROM cache_usage WHERE namespace = ?', (namespace,))
+
+    def usage(self, namespace):
+        # Like MemoryBackend, this counts expired entries until they are dropped
+        row = self._database.execute(
+            'SELECT entries, size FROM cache_usage WHERE namespace = ?', (namespace,),
+        ).fetchone()
+        return tuple(row) if row else (0, 0)
+
+
+# Scheme of MOIRA_CACHE_BACKEND -> function that makes the backend from the rest of it
+BACKENDS = {
+    'memory': lambda _: MemoryBackend(),
+    'sqlite': SQLiteBackend,
+}
+
+
+class Namespace:
+    """
+    A part of the cache with its own TTL and size limit, e.g.
+    `Namespace('credentials', ttl=300, max_bytes=2**24)`
+    """
+
+    def __init__(self, name, ttl, max_bytes):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # Of this process
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = get_backend().get(self.name, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        get_backend().set(self.name, key, value, self.ttl, self.max_bytes)
+
+    def add(self, key, value):
+        return get_backend().add(self.name, key, value, self.ttl, self.max_bytes)
+
+    def clear(self):
+        get_backend().clear(self.name)
+
+    def stats(self):
+        entries, used = get_backend().usage(self.name)
+        return {
+            'entries': entries,
+            'bytes': used,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend() -> CacheBackend:
+    """
+    The backend configured by MOIRA_CACHE_BACKEND (made the first time it is needed)
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                scheme, _, rest = BACKEND.partition(':')
+                _backend = BACKENDS[scheme](rest)
+    return _backend
@@ -0,0 +1,74 @@
+"""
+Per-request deadlines, so that a hung Moira server or SMTP relay
+doesn't pin a worker forever.
+
+Each request gets a deadline (MOIRA_API_TIMEOUT seconds, or what the
+client asks for in the Request-Timeout header, up to MAX_TIMEOUT), and
+anything slow it does (Moira queries, sending email) gives up when it
+passes, raising DeadlineExceeded.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import Counter
+
+# Default time (in seconds) a request may take
+DEFAULT_TIMEOUT = float(os.environ.get('MOIRA_API_TIMEOUT', 30))
+
+# Maximum time (in seconds) a client may ask for
+MAX_TIMEOUT = float(os.environ.get('MOIRA_API_MAX_TIMEOUT', 120))
+
+# Deadline of the current request, in time.monotonic() time
+# (None outside of requests, e.g. in background threads)
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar('deadline', default=None)
+
+# How many times each query (or msmtp) timed out
+_timeouts = Counter()
+_timeouts_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when something takes longer than the time left in the request
+    """
+
+    def __init__(self, what, timeout):
+        super().__init__(f'{what} timed out after {timeout:.1f} seconds')
+        self.what = what
+        self.timeout = timeout
+        with _timeouts_lock:
+            _timeouts[what] += 1
+
+
+def parse_timeout(header):
+    """
+    Parses the Request-Timeout header (in seconds). Raises ValueError if invalid.
+    """
+    if header is None:
+        return DEFAULT_TIMEOUT
+    timeout = float(header)
+    if not timeout > 0:
+        raise ValueError(f'invalid timeout: {header}')
+    return min(timeout, MAX_TIMEOUT)
+
+
+def start_request(timeout):
+    _deadline.set(time.monotonic() + timeout)
+
+
+def time_left():
+    """
+    Seconds until the deadline of the current request (which may be negative).
+    Outside of a request, it is always DEFAULT_TIMEOUT.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return DEFAULT_TIMEOUT
+    return deadline - time.monotonic()
+
+
+def timeout_counts():
+    with _timeouts_lock:
+        return dict(_timeouts)
@@ -1,14 +1,29 @@
 import binascii
 from tempfile import NamedTemporaryFile
-from flask import request, make_response
+from flask import request, make_response, g, current_app
 import json
 import base64
 from make_ccache import make_ccache
 import os
-import moira
 import functools
+import hashlib
 
-from moira_query import moira_query_modwith
+from moira_query import current_ccache, moira_query_modwith
+from admission import Overloaded, current_principal
+from deadlines import DeadlineExceeded
+from timing import span
+from cache_backend import Namespace
+from query_cache import current_credential
+
+# Credentials made from webathena tokens, so that clients which send the same
+# token over and over don't need it decoded and converted every time. The kerb
+# stored with them is only what the token claims (only Moira checks tickets),
+# so nothing is cached on it: query_cache uses the hash of the token instead.
+credential_cache = Namespace(
+    'credentials',
+    ttl=int(os.environ.get('CREDENTIAL_CACHE_TTL', 300)),
+    max_bytes=int(os.environ.get('CREDENTIAL_CACHE_MAX_BYTES', 16 * 2**20)),
+)
 
 
 def plaintext(func):
@@ -36,15 +51,71 @@ def jsoned(func):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         orig_response = func(*args, **kwargs)
-        json_response = orig_response \
-            if isinstance(orig_response, str) or isinstance(orig_response, bytes) \
-            else json.dumps(orig_response)
+        with span('json'):
+            json_response = orig_response \
+                if isinstance(orig_response, str) or isinstance(orig_response, bytes) \
+                else json.dumps(orig_response)
         response = make_response(json_response, 200)
         response.mimetype = 'application/json'
         return response
     return wrapped
 
 
+def get_webathena_token() -> str | None:
+    """
+    The webathena token of the request (see webathena), or None
+    """
+    if 'Authorization' in request.headers:
+        prefix, auth = request.headers['Authorization'].split(' ')
+    elif 'webathena' in request.args:
+        auth = request.args['webathena']
+    else:
+        return None
+    return auth
+
+
+def get_credential(token, key):
+    """
+    Returns the kerb and the ccache for the given token, whose hash is `key`
+    (or an error response)
+    """
+    with span('webathena'):
+        cached = credential_cache.get(key)
+    if cached is not None:
+        kerb_length = int.from_bytes(cached[:4], 'big')
+        return cached[4:4 + kerb_length].decode(), cached[4 + kerb_length:]
+
+    try:
+        with span('webathena'):
+            cred = json.loads(base64.b64decode(token))
+    except binascii.Error:
+        return {'error': {'description': 'Invalid base64 given in "webathena"'}}, 400
+    except json.decoder.JSONDecodeError:
+        return {'error': {'description': 'base64 does not decode to JSON!'}}, 400
+    try:
+        with span('make_ccache'):
+            ccache_bytes = make_ccache(cred)
+        kerb = cred['cname']['nameString'][0]
+    except KeyError as e:
+        return {'error': {'description': f'Malformed credential, missing key {e.args[0]}'}}, 400
+    kerb_bytes = kerb.encode()
+    credential_cache.set(key, len(kerb_bytes).to_bytes(4, 'big') + kerb_bytes + ccache_bytes)
+    return kerb, ccache_bytes
+
+
+def claimed_kerb():
+    """
+    The kerb that the webathena token of the request claims to be (or, in
+    debug mode without one, the local user), or None. Only Moira checks
+    tickets, so this is not proof of anything.
+    """
+    token = get_webathena_token()
+    if not token:
+        return os.environ['USER'] if current_app.debug else None
+    credential = get_credential(token, hashlib.sha256(token.encode()).hexdigest())
+    return None if isinstance(credential[0], dict) else credential[0]
+
+
 def webathena(func):
     """
     Decorator that makes sure a webathena token is passed to the request.
@@ -58,62 +129,69 @@ def webathena(func):
     Pattern inspired by mailto code.
     """
 
-    def get_webathena_json() -> dict | None:
-        if 'Authorization' in request.headers:
-            prefix, auth = request.headers['Authorization'].split(' ')
-        elif 'webathena' in request.args:
-            auth = request.args['webathena']
-        else:
-            return None
-        return json.loads(base64.b64decode(auth))
-
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
-        try:
-            cred = get_webathena_json()
-        except binascii.Error:
-            return {'error': {'description': 'Invalid base64 given in "webathena"'}}, 400
-        except json.decoder.JSONDecodeError:
-            return {'error': {'description': 'base64 does not decode to JSON!'}}, 400
-        if not cred:
-            from api import app
+        token = get_webathena_token()
+        if not token:
             # Make local testing easier by using own tickets
-            if app.debug:
+            g.webathena_cred = None
+            if current_app.debug:
+                current_principal.set(os.environ['USER'])
                 return func(*args, **kwargs, kerb=os.environ['USER'])
             else:
                 return {'error': {'description': 'No authentication given!'}}, 401
-        else:
-            # temporary file only exists in "with" scope
-            with NamedTemporaryFile(prefix='ccache_') as ccache:
-                try:
-                    ccache.write(make_ccache(cred))
-                    kerb = cred['cname']['nameString'][0]
-                except KeyError as e:
-                    return {'error': {'description': f'Malformed credential, missing key {e.args[0]}'}}, 400
+
+        # Identifies the credential (unlike the kerb, which is only what the token claims)
+        key = hashlib.sha256(token.encode()).hexdigest()
+        credential = get_credential(token, key)
+        if isinstance(credential[0], dict):
+            # Error response
+            return credential
+        kerb, ccache_bytes = credential
+        # Keep the credential around for work that outlives the ccache file below
+        # (see moira_query_cred)
+        g.webathena_cred = ccache_bytes
+
+        # temporary file only exists in "with" scope
+        with NamedTemporaryFile(prefix='ccache_') as ccache:
+            with span('ccache_write'):
+                ccache.write(ccache_bytes)
                 ccache.flush()
-                os.environ['KRB5CCNAME'] = ccache.name
-                response = func(*args, **kwargs, kerb=kerb)
-
-                # Make sure to unset the environment variable, just in case
-                # Only if it exists that is
-                if 'KRB5CCNAME' in os.environ:
-                    del os.environ['KRB5CCNAME']
-                return response
+            # Not os.environ['KRB5CCNAME'], which other threads would see too
+            ccache_token = current_ccache.set(ccache.name)
+            # For profiling and jobs
+            current_principal.set(kerb)
+            # For query_cache and admission control
+            credential_token = current_credential.set(key)
+            try:
+                return func(*args, **kwargs, kerb=kerb)
+            finally:
+                current_credential.reset(credential_token)
+                current_ccache.reset(ccache_token)
     return wrapped
 
 
-_moira_errors_inverse = {v:k for k,v in moira.errors().items()}
+@functools.cache
+def _moira_errors_inverse():
+    import moira
+    return {v:k for k,v in moira.errors().items()}
+
 def get_moira_error_name(code):
-    return _moira_errors_inverse.get(code) or 'unknown error'
+    return _moira_errors_inverse().get(code) or 'unknown error'
 
 def moira_errors(func):
     """
     A decorator that parses Moira errors and returns them
     according to the API spec (as a Flask result, status code tuple)
+
+    Queries rejected by admission control (with a Retry-After header)
+    or that time out are returned the same way
     """
 
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
+        # Only loaded when needed (see create_app)
+        import moira
         try:
             response = func(*args, **kwargs)
             return response
@@ -142,6 +220,19 @@ def moira_errors(func):
                 'name': error_name,
                 'message': error_message,
             }, status_code
+        except Overloaded as e:
+            # Not a Moira error, but keep the same structure
+            return {
+                'code': None,
+                'name': e.name,
+                'message': e.message,
+            }, e.status_code, {'Retry-After': str(e.retry_after)}
+        except DeadlineExceeded as e:
+            return {
+                'code': None,
+                'name': 'TIMEOUT',
+                'message': str(e),
+            }, 504
 
     return wrapped
 
@@ -165,7 +256,9 @@ def allow_changing_modwith(func):
             modwith = "python3"
         def moira_query(*args, **kwargs):
             return moira_query_modwith(modwith, *args, **kwargs)
-        return func(moira_query, *args, **kwargs)
+        # Time spent in the route itself (i.e. shaping the results)
+        with span('route'):
+            return func(moira_query, *args, **kwargs)
 
     return wrapped
 
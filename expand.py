@@ -0,0 +1,227 @@
+"""
+Nested expansion (the `expand` parameter), so that clients can get, e.g.,
+the members of a list along with the owner of each sub-list in one request
+instead of one request per sub-list.
+
+`expand` is a comma-separated list of dotted paths of fields to add, like
+`lists.owner,lists.members.users.info`. The names in the output become
+objects with a `name` and the requested fields.
+
+Fields of a list:
+* info: like GET /lists/{name}/
+* owner: like GET /lists/{name}/owner
+* member_count: number of (direct) members
+* members: like GET /lists/{name}/members/, which can be expanded further
+
+Fields of a user:
+* info: like GET /users/{user}/, but with the user's own kerb
+
+Everything needed at each level is loaded at once, each list or user only
+once, running the queries concurrently. Results of get_list_info and
+get_user_by_login go through query_cache.
+"""
+
+import concurrent.futures
+import contextvars
+import os
+
+import query_cache
+import timing
+from util import parse_list_info, parse_members, parse_user
+
+# How many levels of lists and users can be loaded (e.g. lists.members.lists.info is 2)
+MAX_DEPTH = int(os.environ.get('MOIRA_EXPAND_MAX_DEPTH', 3))
+
+# How many Moira queries expanding a single request may run
+MAX_QUERIES = int(os.environ.get('MOIRA_EXPAND_MAX_QUERIES', 200))
+
+# How many of those run at once (same as the default MOIRA_MAX_CONCURRENCY_PER_USER)
+CONCURRENCY = int(os.environ.get('MOIRA_EXPAND_CONCURRENCY', 4))
+
+# Field -> query that loads it
+LIST_FIELDS = {
+    'info': 'get_list_info',
+    'owner': 'get_list_info',
+    'member_count': 'get_members_of_list',
+    'members': 'get_members_of_list',
+}
+USER_FIELDS = {
+    'info': 'get_user_by_login',
+}
+
+# Kinds of members that can be expanded, and what they are
+MEMBER_KINDS = {
+    'lists': 'list',
+    'users': 'user',
+}
+
+
+class ExpandError(Exception):
+    """
+    Raised if `expand` is invalid or would take too many queries
+    """
+
+    def __init__(self, name, message):
+        super().__init__(message)
+        self.name = name
+        self.message = message
+
+
+def parse_expand(values, root):
+    """
+    Parses `expand` parameters into a tree of fields, e.g.
+    {'lists': {'owner': {}}}, checking it against the output of the route
+    (`root` is "members" for members of a list, or "list" for lists of lists)
+    """
+    tree = {}
+    for value in values:
+        for path in value.split(','):
+            path = path.strip()
+            if not path:
+                continue
+            node = tree
+            for field in path.split('.'):
+                node = node.setdefault(field, {})
+    _check(tree, root, 1, '')
+    return tree
+
+
+def _check(tree, kind, depth, prefix):
+    if kind == 'members':
+        fields = MEMBER_KINDS
+    elif kind == 'list':
+        fields = LIST_FIELDS
+    else:
+        fields = USER_FIELDS
+    for field, subtree in tree.items():
+        path = prefix + field
+        if field not in fields:
+            raise ExpandError('INVALID_EXPAND', f'{path} can not be expanded (try one of: {", ".join(fields)})')
+        if kind == 'members':
+            _check(subtree, MEMBER_KINDS[field], depth, path + '.')
+        elif field == 'members':
+            if depth >= MAX_DEPTH:
+                raise ExpandError('INVALID_EXPAND', f'{path} is nested too deep (at most {MAX_DEPTH} levels)')
+            _check(subtree, 'members', depth + 1, path + '.')
+        elif subtree:
+            raise ExpandError('INVALID_EXPAND', f'{path} has no fields to expand')
+
+
+class Loader:
+    """
+    Runs the queries needed to expand a request, each at most once
+    """
+
+    def __init__(self, moira_query):
+        self.moira_query = moira_query
+        # (query, name) -> result, or the MoiraException it raised
+        self.results = {}
+
+    def _run(self, query, name):
+        # The stages of concurrent queries would overlap (see load)
+        timing.detach()
+        if query in ('get_list_info', 'get_user_by_login'):
+            return query_cache.cached_query(self.moira_query, query, [name])[0]
+        return self.moira_query(query, name)
+
+    def load(self, wanted):
+        """
+        Runs the given (query, name) pairs that haven't been run yet, all at once
+        """
+        import moira
+        missing = [key for key in dict.fromkeys(wanted) if key not in self.results]
+        if not missing:
+            return
+        if len(self.results) + len(missing) > MAX_QUERIES:
+            raise ExpandError('EXPAND_TOO_EXPENSIVE', f'Expanding this would take more than {MAX_QUERIES} queries')
+        with timing.span('expand'), concurrent.futures.ThreadPoolExecutor(CONCURRENCY) as executor:
+            # Each query gets a copy of the request's context (deadline, credential, ...)
+            futures = {
+                key: executor.submit(contextvars.copy_context().run, self._run, *key)
+                for key in missing
+            }
+            for key, future in futures.items():
+                try:
+                    self.results[key] = future.result()
+                except moira.MoiraException as e:
+                    self.results[key] = e
+
+    def get(self, query, name):
+        return self.results[(query, name)]
+
+
+def _moira_error(e):
+    from decorators import get_moira_error_name
+    return {
+        'code': e.code,
+        'name': get_moira_error_name(e.code),
+        'message': e.args[1].decode(),
+    }
+
+
+def _fill(loader, node, kind, tree):
+    """
+    Adds the fields in `tree` to a node (which must have been loaded),
+    and returns the nodes of the next level
+    """
+    fields = LIST_FIELDS if kind == 'list' else USER_FIELDS
+    next_level = []
+    for field, subtree in tree.items():
+        result = loader.get(fields[field], node['name'])
+        if isinstance(result, Exception):
+            node['error'] = _moira_error(result)
+            continue
+        if kind == 'user':
+            node[field] = parse_user(result[0], node['name'])
+        elif field == 'info':
+            node[field] = parse_list_info(result[0])
+        elif field == 'owner':
+            node[field] = parse_list_info(result[0])['owner']
+        elif field == 'member_count':
+            node[field] = len(result)
+        else:
+            members = parse_members(result)
+            for member_kind, member_tree in subtree.items():
+                nodes = [{'name': name} for name in members[member_kind]]
+                members[member_kind] = nodes
+                next_level += [(member, MEMBER_KINDS[member_kind], member_tree) for member in nodes]
+            node[field] = members
+    return next_level
+
+
+def _resolve(loader, level):
+    """
+    Fills in (node, kind, tree) triples, one level at a time
+    """
+    while level:
+        loader.load(
+            ((LIST_FIELDS if kind == 'list' else USER_FIELDS)[field], node['name'])
+            for node, kind, tree in level
+            for field in tree
+        )
+        next_level = []
+        for node, kind, tree in level:
+            next_level += _fill(loader, node, kind, tree)
+        level = next_level
+
+
+def expand_lists(loader, lists, tree):
+    """
+    Expands a list of lists (either names, or dicts with a name)
+    """
+    nodes = [{'name': entry} if isinstance(entry, str) else entry for entry in lists]
+    _resolve(loader, [(node, 'list', tree) for node in nodes])
+    return nodes
+
+
+def expand_members(loader, members, tree):
+    """
+    Expands the output of parse_members
+    """
+    level = []
+    for member_kind, member_tree in tree.items():
+        nodes = [{'name': name} for name in members[member_kind]]
+        members[member_kind] = nodes
+        level += [(node, MEMBER_KINDS[member_kind], member_tree) for node in nodes]
+    _resolve(loader, level)
+    return members
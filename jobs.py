@@ -0,0 +1,342 @@
+"""
+Background jobs for writes, so that bulk tools don't have to keep a
+request open for every change.
+
+Write routes decorated with allow_async accept a `Prefer: respond-async`
+header: instead of running the write, they save the request as a job and
+return 202 right away. Jobs are run later by replaying the request (with
+the caller's credential) and their results, in the same format as the
+route's response, are available at GET /jobs/<id>.
+
+Jobs on the same list run one at a time, in the order they were accepted,
+while jobs on different lists run in parallel. They are kept in a SQLite
+database (MOIRA_JOBS_DB), which all the worker processes on a host share,
+so jobs are not lost if the server restarts. A running job is leased to
+the process running it, which keeps renewing the lease; if the lease runs
+out (e.g. the process died), the job is run again.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app, g, make_response, request
+
+from admission import current_principal
+from query_cache import current_credential
+from decorators import moira_errors
+from moira_query import moira_query_cred
+from sqlite_db import SQLiteDatabase
+
+logger = logging.getLogger('moira_api.jobs')
+
+JOBS_DB = os.environ.get('MOIRA_JOBS_DB', 'jobs.db')
+
+# Jobs run at once by each server process
+JOB_THREADS = int(os.environ.get('MOIRA_JOB_THREADS', 4))
+
+# How long (in seconds) results of finished jobs are kept
+JOB_RETENTION = int(os.environ.get('MOIRA_JOB_RETENTION', 24 * 60 * 60))
+
+# How often (in seconds) to look for jobs accepted by other processes
+POLL_INTERVAL = 1
+
+# How long (in seconds) a running job is leased for. Leases are renewed
+# every LEASE_TIME / 3 seconds while the job runs.
+LEASE_TIME = 60
+
+# Route name -> view function (see allow_async)
+_routes = {}
+
+_wakeup = threading.Event()
+_started_pid = None
+_start_lock = threading.Lock()
+# Identifies this process in the leases it holds (pids may be reused)
+_instance = None
+# seq of the jobs this process is running
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _setup(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            route TEXT NOT NULL,
+            list_name TEXT NOT NULL,
+            kerb TEXT NOT NULL,
+            -- ccache of the caller, deleted once the job is over
+            cred BLOB,
+            modwith TEXT NOT NULL,
+            method TEXT NOT NULL,
+            path TEXT NOT NULL,
+            query_string TEXT NOT NULL,
+            body TEXT,
+            view_args TEXT NOT NULL,
+            -- pending, running, done or failed
+            status TEXT NOT NULL,
+            status_code INTEGER,
+            result TEXT,
+            -- instance (see _instance) running the job, and until when
+            runner TEXT,
+            lease_expires REAL,
+            not_before REAL NOT NULL DEFAULT 0,
+            created REAL NOT NULL,
+            finished REAL
+        )
+    """)
+    if 'lease_expires' not in {column['name'] for column in db.execute('PRAGMA table_info(jobs)')}:
+        # Made by a version that kept the pid of the runner instead,
+        # so let whatever was running then run again
+        db.execute('ALTER TABLE jobs ADD COLUMN lease_expires REAL')
+        db.execute("UPDATE jobs SET lease_expires = 0 WHERE status = 'running'")
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_by_list ON jobs (list_name, status, seq)')
+
+
+# Only readable by the user running the API, since it holds tickets
+_database = SQLiteDatabase(JOBS_DB, row_factory=sqlite3.Row, setup=_setup)
+
+
+def _submit(route, list_name, kerb, cred, modwith, view_args):
+    job_id = uuid.uuid4().hex
+    _database.execute(
+        """
+        INSERT INTO jobs (id, route, list_name, kerb, cred, modwith, method, path, query_string,
+                          body, view_args, status, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)
+        """,
+        (
+            job_id, route, list_name, kerb, cred, modwith, request.method, request.path,
+            request.query_string.decode(), request.get_data(as_text=True) or None,
+            json.dumps(view_args), time.time(),
+        ),
+    )
+    _wakeup.set()
+    return job_id
+
+
+def allow_async(func):
+    """
+    Decorator for write routes (inside authenticated_moira, which gives it
+    the caller's credential) that runs the write as a job if the client sent
+    `Prefer: respond-async`. The route must have a `list_name` parameter.
+    """
+    _routes[func.__name__] = func
+
+    @functools.wraps(func)
+    def wrapped(moira_query, *args, kerb, **kwargs):
+        if 'respond-async' not in request.headers.get('Prefer', ''):
+            return func(moira_query, *args, kerb=kerb, **kwargs)
+        ensure_running(current_app._get_current_object())
+        job_id = _submit(
+            func.__name__, kwargs['list_name'], kerb, g.webathena_cred,
+            request.headers.get('modwith', 'python3'), kwargs,
+        )
+        return {'id': job_id, 'status': 'pending'}, 202, {
+            'Location': f'/jobs/{job_id}',
+            'Preference-Applied': 'respond-async',
+        }
+    return wrapped
+
+
+def _claim():
+    """
+    Marks the next job that can run as running (by this process) and returns it.
+    A job can run once every job accepted before it on the same list is over.
+    """
+    with _database.transaction() as db:
+        job = db.execute(
+            """
+            SELECT * FROM jobs AS job
+            WHERE status = 'pending' AND not_before <= ? AND seq = (
+                SELECT MIN(seq) FROM jobs
+                WHERE list_name = job.list_name AND status IN ('pending', 'running')
+            )
+            ORDER BY seq LIMIT 1
+            """,
+            (time.time(),),
+        ).fetchone()
+        if job is not None:
+            db.execute(
+                "UPDATE jobs SET status = 'running', runner = ?, lease_expires = ? WHERE seq = ?",
+                (_instance, time.time() + LEASE_TIME, job['seq']),
+            )
+            with _running_lock:
+                _running.add(job['seq'])
+    return job
+
+
+def _run(app, job):
+    """
+    Replays the request of a job and returns (status code, body)
+    """
+    func = _routes.get(job['route'])
+    if func is None:
+        return 500, {'code': None, 'name': 'UNKNOWN_ROUTE', 'message': f'{job["route"]} can not be run as a job'}
+
+    cred = job['cred']
+    modwith = job['modwith']
+    def moira_query(*args, **kwargs):
+        return moira_query_cred(cred, modwith, *args, **kwargs)
+
+    current_principal.set(job['kerb'])
+    # For admission control (the token itself isn't kept)
+    current_credential.set(hashlib.sha256(cred).hexdigest() if cred is not None else None)
+    body = job['body']
+    with app.test_request_context(
+        job['path'], method=job['method'], query_string=job['query_string'],
+        data=body, content_type='application/json' if body else None,
+    ):
+        response = make_response(moira_errors(func)(moira_query, kerb=job['kerb'], **json.loads(job['view_args'])))
+        return response.status_code, response.get_json() if response.is_json else response.get_data(as_text=True)
+
+
+def _finish(job, status_code, result, retry_after=None):
+    """
+    Saves the result of a job, unless its lease ran out (and someone else runs it now)
+    """
+    db = _database.connection()
+    if retry_after is not None:
+        # Try again later, without letting later jobs on the list go first
+        db.execute(
+            """
+            UPDATE jobs SET status = 'pending', runner = NULL, not_before = ?
+            WHERE seq = ? AND status = 'running' AND runner = ?
+            """,
+            (time.time() + retry_after, job['seq'], _instance),
+        )
+        return
+    db.execute(
+        """
+        UPDATE jobs SET status = ?, status_code = ?, result = ?, cred = NULL, finished = ?
+        WHERE seq = ? AND status = 'running' AND runner = ?
+        """,
+        (
+            'done' if status_code < 400 else 'failed', status_code, json.dumps(result), time.time(),
+            job['seq'], _instance,
+        ),
+    )
+
+
+def _renew_leases():
+    with _running_lock:
+        running = list(_running)
+    _database.connection().executemany(
+        "UPDATE jobs SET lease_expires = ? WHERE seq = ? AND status = 'running' AND runner = ?",
+        [(time.time() + LEASE_TIME, seq, _instance) for seq in running],
+    )
+
+
+def _reset_abandoned():
+    """
+    Lets jobs whose lease ran out (e.g. their process died) run again,
+    and forgets old results
+    """
+    db = _database.connection()
+    db.execute(
+        "UPDATE jobs SET status = 'pending', runner = NULL WHERE status = 'running' AND lease_expires < ?",
+        (time.time(),),
+    )
+    db.execute('DELETE FROM jobs WHERE finished < ?', (time.time() - JOB_RETENTION,))
+
+
+def _work_forever(app):
+    while True:
+        try:
+            job = _claim()
+        except sqlite3.Error:
+            logger.exception('could not claim a job')
+            job = None
+        if job is None:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        try:
+            status_code, result = _run(app, job)
+        except Exception as e:
+            logger.exception('job %s failed', job['id'])
+            status_code, result = 500, {'code': None, 'name': 'INTERNAL_ERROR', 'message': repr(e)}
+        try:
+            if status_code in (429, 503):
+                # Rejected by admission control
+                _finish(job, status_code, result, retry_after=POLL_INTERVAL)
+            else:
+                _finish(job, status_code, result)
+        except sqlite3.Error:
+            # Once its lease runs out, the job will be run again
+            logger.exception('could not save the result of job %s', job['id'])
+        finally:
+            with _running_lock:
+                _running.discard(job['seq'])
+        # The next job on the list may be able to run now
+        _wakeup.set()
+
+
+def _housekeep_forever():
+    while True:
+        try:
+            _renew_leases()
+            _reset_abandoned()
+        except sqlite3.Error:
+            logger.exception('housekeeping failed')
+        _wakeup.set()
+        time.sleep(LEASE_TIME / 3)
+
+
+def ensure_running(app):
+    """
+    Starts running jobs in this process (if it hasn't already)
+    """
+    global _started_pid, _instance
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        _instance = uuid.uuid4().hex
+        # Inherited from the parent process, if forked
+        _running.clear()
+        threading.Thread(target=_housekeep_forever, daemon=True).start()
+        for _ in range(JOB_THREADS):
+            threading.Thread(target=_work_forever, args=(app,), daemon=True).start()
+
+
+def resume(app):
+    """
+    Starts running jobs in this process if any were ever accepted
+    (e.g. before a restart)
+    """
+    if _started_pid != os.getpid() and os.path.exists(JOBS_DB):
+        ensure_running(app)
+
+
+def get_job(job_id, kerb):
+    """
+    The status (and, once it is over, the result) of a job, or None
+    if there is no such job or it was not made by the given kerb
+    """
+    job = _database.execute('SELECT * FROM jobs WHERE id = ? AND kerb = ?', (job_id, kerb)).fetchone()
+    if job is None:
+        return None
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'list': job['list_name'],
+        'request': f'{job["method"]} {job["path"]}',
+        'created': job['created'],
+        'finished': job['finished'],
+        'status_code': job['status_code'],
+        'result': json.loads(job['result']) if job['result'] is not None else None,
+    }
+
+
+def stats():
+    return dict(_database.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
@@ -0,0 +1,178 @@
+"""
+In-memory index of list names, so that clients can search for lists
+(e.g. for autocomplete) without downloading every list name.
+
+The index is built from the output of qualified_get_lists, one index
+per set of filters, and is refreshed in a background thread once it
+becomes stale (stale results are served in the meantime).
+
+Indexes are shared by everyone, so they are only kept for filters whose
+results are the same for everyone (see shareable).
+"""
+
+import bisect
+import heapq
+import os
+import threading
+import time
+from array import array
+
+# How old (in seconds) an index can get before it is refreshed
+LIST_INDEX_TTL = int(os.environ.get('LIST_INDEX_TTL', 300))
+
+# Length of the n-grams used for substring search
+NGRAM = 3
+
+# Characters that separate "words" in list names (e.g. sipb-office)
+WORD_SEPARATORS = '-_.'
+
+
+def _ngrams(s):
+    return {s[i:i + NGRAM] for i in range(len(s) - NGRAM + 1)}
+
+
+def _rank(key, q):
+    """
+    Sort key for a match (a lowercase name containing q): exact matches
+    first, then prefixes, then matches at the start of a word, then any
+    other substring. Ties are broken by position of the match and then by length.
+    """
+    pos = key.find(q)
+    if key == q:
+        kind = 0
+    elif pos == 0:
+        kind = 1
+    elif key[pos - 1] in WORD_SEPARATORS:
+        kind = 2
+    else:
+        kind = 3
+    return (kind, pos, len(key), key)
+
+
+class ListIndex:
+    """
+    A sorted array of list names (for prefix search through binary search)
+    plus an n-gram index (for substring search)
+    """
+
+    def __init__(self, names):
+        pairs = sorted((name.lower(), name) for name in set(names))
+        self.keys = [key for key, _ in pairs]
+        self.names = [name for _, name in pairs]
+        self.ngrams: dict[str, array] = {}
+        for i, key in enumerate(self.keys):
+            for gram in _ngrams(key):
+                # i only goes up, so every postings array stays sorted
+                self.ngrams.setdefault(gram, array('I')).append(i)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def prefix_matches(self, q):
+        """
+        Indices of the names starting with q
+        """
+        start = bisect.bisect_left(self.keys, q)
+        end = bisect.bisect_left(self.keys, q + '\U0010ffff', lo=start)
+        return range(start, end)
+
+    def substring_matches(self, q):
+        """
+        Indices of the names containing q
+        """
+        if len(q) < NGRAM:
+            # Too short to use the n-gram index
+            candidates = range(len(self.keys))
+        else:
+            postings = [self.ngrams.get(gram) for gram in _ngrams(q)]
+            if not all(postings):
+                return []
+            # Every match must be in every postings array, so checking
+            # the shortest one is enough
+            candidates = min(postings, key=len)
+        return [i for i in candidates if q in self.keys[i]]
+
+    def search(self, q, limit, substring=True):
+        """
+        Returns up to `limit` list names matching q, best matches first
+        """
+        q = q.lower()
+        if not q:
+            return []
+        matches = self.substring_matches(q) if substring else self.prefix_matches(q)
+        best = heapq.nsmallest(limit, matches, key=lambda i: _rank(self.keys[i], q))
+        return [self.names[i] for i in best]
+
+
+def search(names, q, limit, substring=True):
+    """
+    Same as ListIndex(names).search, but without building an index, which
+    is much faster for a single search
+    """
+    q = q.lower()
+    if not q:
+        return []
+    matches = [
+        (key, name)
+        for key, name in {(name.lower(), name) for name in names}
+        if (q in key if substring else key.startswith(q))
+    ]
+    best = heapq.nsmallest(limit, matches, key=lambda match: (_rank(match[0], q), match[1]))
+    return [name for _, name in best]
+
+
+def shareable(filters):
+    """
+    Whether the lists matching the given qualified_get_lists filters are the
+    same for everyone, so that their index can be shared: Moira only lets
+    admins look for inactive or hidden lists
+    """
+    active, _, hidden, _, _ = filters
+    return active == 'TRUE' and hidden == 'FALSE'
+
+
+class _IndexEntry:
+    def __init__(self, index):
+        self.index = index
+        self.built_at = time.monotonic()
+        self.refreshing = False
+
+
+_indexes: dict[tuple, _IndexEntry] = {}
+_indexes_lock = threading.Lock()
+
+
+def _refresh(filters, load_names):
+    try:
+        index = ListIndex(load_names())
+    except Exception:
+        # Keep serving the old index, and try again on the next request
+        with _indexes_lock:
+            _indexes[filters].refreshing = False
+        raise
+    with _indexes_lock:
+        _indexes[filters] = _IndexEntry(index)
+
+
+def get_list_index(filters, load_names):
+    """
+    Gets the index for the given qualified_get_lists filters, which must
+    be shareable.
+
+    `load_names` is a function returning every list name matching the filters.
+    It is called right away if there is no index yet, or in a background
+    thread if the index is stale, so it must not depend on the request context.
+    """
+    with _indexes_lock:
+        entry = _indexes.get(filters)
+        if entry is not None:
+            if not entry.refreshing and time.monotonic() - entry.built_at > LIST_INDEX_TTL:
+                entry.refreshing = True
+                threading.Thread(target=_refresh, args=(filters, load_names), daemon=True).start()
+            return entry.index
+    # If several requests get here at once, they will all build it,
+    # but only the first time, so that's fine
+    index = ListIndex(load_names())
+    with _indexes_lock:
+        _indexes[filters] = _IndexEntry(index)
+    return index
@@ -0,0 +1,242 @@
+"""
+Change feed for lists, sent as Server-Sent Events, so that dashboards
+don't have to poll Moira themselves.
+
+A single background thread polls every watched list once per interval,
+no matter how many clients are watching it: it runs get_list_info and,
+only if the modtime changed, get_members_of_list. Changes are sent to
+every subscriber as the attributes that changed and the members that were
+added or removed. Writes made through this API are picked up right away.
+
+The poller runs the queries with the credential of one of the
+subscribers (each subscriber is checked to have access when it subscribes).
+If Moira turns that credential down, its subscriber gets an error event and
+stops getting changes to the list, and the next subscriber's is tried.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+
+from decorators import get_moira_error_name
+from moira_query import CLIENT_NAME, after_query_hooks, moira_query_cred
+from util import parse_list_info, parse_members
+
+logger = logging.getLogger('moira_api.list_watch')
+
+# How often (in seconds) watched lists are checked for changes
+POLL_INTERVAL = float(os.environ.get('LIST_WATCH_INTERVAL', 10))
+
+# How often (in seconds) to send something to idle subscribers, so that
+# proxies don't close the connection
+KEEPALIVE_INTERVAL = 15
+
+# How many events may be waiting for a subscriber before we give up on it
+MAX_PENDING_EVENTS = 100
+
+
+def _format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def _diff_members(old, new):
+    added = {}
+    removed = {}
+    for member_type in new:
+        old_names = set(old[member_type])
+        new_names = set(new[member_type])
+        added[member_type] = sorted(new_names - old_names)
+        removed[member_type] = sorted(old_names - new_names)
+    return added, removed
+
+
+class _WatchedList:
+    def __init__(self, name, info, members):
+        self.name = name
+        # As returned by parse_list_info and parse_members
+        self.info = info
+        self.members = members
+        # Subscriber queue -> credential of the subscriber (see moira_query_cred)
+        self.subscribers: dict[queue.Queue, bytes | None] = {}
+
+    def snapshot(self):
+        return {'list': self.name, 'info': self.info, 'members': self.members}
+
+    def _send(self, subscriber, message):
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # Too slow, the subscriber will have to reconnect
+            del self.subscribers[subscriber]
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            subscriber.put_nowait(None)
+
+    def broadcast(self, event, data):
+        message = _format_event(event, data)
+        for subscriber in list(self.subscribers):
+            self._send(subscriber, message)
+
+    def drop(self, subscriber, event, data):
+        """
+        Sends a last event to a subscriber and stops sending it changes to this list
+        """
+        if subscriber not in self.subscribers:
+            # Already gone
+            return
+        self._send(subscriber, _format_event(event, data))
+        self.subscribers.pop(subscriber, None)
+
+
+_watched: dict[str, _WatchedList] = {}
+_lock = threading.Lock()
+# Lists to check right away because they were written to
+_dirty: set[str] = set()
+_wakeup = threading.Event()
+_poller = None
+
+
+def _credential_error(e):
+    """
+    Whether a MoiraException is about the credential the query was run with
+    (no permission, expired tickets...) rather than about the list itself
+    """
+    # Kerberos errors are not Moira errors
+    return get_moira_error_name(e.code) in ('MR_PERM', 'unknown error')
+
+
+def _check(watched, force):
+    """
+    Polls a list and lets subscribers know if anything changed
+    """
+    with _lock:
+        subscribers = list(watched.subscribers.items())
+    import moira
+    # Newest first, since their tickets are the least likely to have expired
+    for subscriber, cred in reversed(subscribers):
+        try:
+            info = parse_list_info(moira_query_cred(cred, CLIENT_NAME, 'get_list_info', watched.name)[0])
+            if not force and info['last_modified'] == watched.info['last_modified']:
+                return
+            members = parse_members(moira_query_cred(cred, CLIENT_NAME, 'get_members_of_list', watched.name))
+            break
+        except moira.MoiraException as e:
+            error = {
+                'list': watched.name,
+                'code': e.code,
+                'message': e.args[1].decode(),
+            }
+            with _lock:
+                if not _credential_error(e):
+                    watched.broadcast('error', error)
+                    return
+                # Only this subscriber can't see the list (anymore), so
+                # let it know and try with someone else's credential
+                watched.drop(subscriber, 'error', error)
+                if not watched.subscribers and _watched.get(watched.name) is watched:
+                    del _watched[watched.name]
+    else:
+        return
+
+    attributes = {k: v for k, v in info.items() if watched.info.get(k) != v}
+    added, removed = _diff_members(watched.members, members)
+    with _lock:
+        watched.info = info
+        watched.members = members
+        if attributes or any(added.values()) or any(removed.values()):
+            watched.broadcast('change', {
+                'list': watched.name,
+                'attributes': attributes,
+                'members': {'added': added, 'removed': removed},
+            })
+
+
+def _poll_forever():
+    while True:
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+        with _lock:
+            dirty = _dirty.copy()
+            _dirty.clear()
+            watched_lists = list(_watched.values())
+        for watched in watched_lists:
+            try:
+                _check(watched, force=watched.name in dirty)
+            except Exception:
+                # Keep polling the other lists
+                logger.exception('error checking %s', watched.name)
+
+
+def _on_query(query, args, kwargs):
+    """
+    Hook (see moira_query.after_query_hooks) that checks lists
+    right away when they are changed through this API
+    """
+    if query in ('update_list', 'delete_list', 'add_member_to_list', 'delete_member_from_list'):
+        list_name = kwargs.get('name') or (args[0] if args else None)
+        with _lock:
+            if list_name in _watched:
+                _dirty.add(list_name)
+                _wakeup.set()
+
+after_query_hooks.append(_on_query)
+
+
+def subscribe(moira_query, cred, list_names):
+    """
+    Starts watching the given lists on behalf of the current user (the
+    initial queries are run with moira_query, so that Moira checks they
+    are allowed to see the lists), and returns a subscriber queue.
+    The user's credential (see moira_query_cred) may be used to poll the lists later.
+
+    Raises MoiraException if any list can't be read.
+    """
+    global _poller
+
+    snapshots = {}
+    for name in list_names:
+        info = parse_list_info(moira_query('get_list_info', name)[0])
+        members = parse_members(moira_query('get_members_of_list', name))
+        snapshots[name] = (info, members)
+
+    subscriber = queue.Queue(MAX_PENDING_EVENTS)
+    with _lock:
+        for name, (info, members) in snapshots.items():
+            if name not in _watched:
+                _watched[name] = _WatchedList(name, info, members)
+            watched = _watched[name]
+            watched.subscribers[subscriber] = cred
+            # Changes will be relative to this
+            subscriber.put_nowait(_format_event('snapshot', watched.snapshot()))
+        if _poller is None:
+            _poller = threading.Thread(target=_poll_forever, daemon=True)
+            _poller.start()
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with _lock:
+        for name, watched in list(_watched.items()):
+            watched.subscribers.pop(subscriber, None)
+            if not watched.subscribers:
+                del _watched[name]
+
+
+def stream(subscriber):
+    """
+    Generator of the Server-Sent Events for a subscriber
+    """
+    try:
+        while True:
+            try:
+                message = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                return
+            yield message
+    finally:
+        unsubscribe(subscriber)
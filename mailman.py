@@ -1,11 +1,14 @@
 import subprocess
+from deadlines import DeadlineExceeded, time_left
+from moira_query import ccache_env
 
 
 def send_email(kerb, to_address, subject, body):
     """
     Send an email (using msmtp).
 
-    Returns nothing, but may raise an OSError(msmtp exit code, msmtp stderr)
+    Returns nothing, but may raise an OSError(msmtp exit code, msmtp stderr),
+    or DeadlineExceeded if msmtp is still running when the request deadline passes
     """
     command = [
         "msmtp",  # What sendmail on Athena calls
@@ -19,9 +22,17 @@ def send_email(kerb, to_address, subject, body):
     ]
     email = "\n".join([f"Subject: {subject}", f"{body}"])
     # We are only capturing stderr
-    result = subprocess.run(
-        command, input=email, encoding="utf-8", stderr=subprocess.PIPE
-    )
+    timeout = time_left()
+    try:
+        # subprocess.run kills msmtp if it times out
+        result = subprocess.run(
+            command, input=email, encoding="utf-8", stderr=subprocess.PIPE,
+            timeout=max(timeout, 0),
+            # Authenticate as the caller, not with the server's own tickets
+            env=ccache_env(),
+        )
+    except subprocess.TimeoutExpired:
+        raise DeadlineExceeded("msmtp", timeout)
     if result.returncode != 0:
         raise OSError(result.returncode, result.stderr)
 
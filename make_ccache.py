@@ -5,11 +5,38 @@ into a credential cache ("ccache") that actual desktop utilities or APIs can use
 make_ccache is the important function (the rest are helper functions)
 
 Taken from SSH (shellinabox) example in https://github.com/davidben/webathena.
+
+Unlike the original, the ccache is written back to front into a single
+preallocated buffer: DER lengths and ccache counted strings come before
+their contents, but when writing backwards the contents are already
+there by the time we need their length, so nothing has to be copied
+or concatenated.
 """
 
 import base64
 import struct
-from tempfile import NamedTemporaryFile
+
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_HEADER = struct.Struct("!HHHHII")
+_PRINCIPAL_HEADER = struct.Struct("!II")
+_TIMES = struct.Struct("!IIII")
+# is_skey, ticket_flags, num_address, num_authdata
+_CREDENTIAL_FLAGS = struct.Struct("!BIII")
+
+# Upper bound of the bytes needed by everything but the strings and blobs
+# in the credential (fixed-size fields, DER tags and lengths, ...)
+_FIXED_OVERHEAD = 256
+# Upper bound of the bytes needed around each string or blob
+_ITEM_OVERHEAD = 16
+
+# All the _put functions write data ending right before `pos` in `buf`,
+# and return the new position (the start of what they wrote).
+
+def _put_bytes(buf: bytearray, pos: int, data: bytes) -> int:
+    start = pos - len(data)
+    buf[start:pos] = data
+    return start
 
 # Some DER encoding stuff. Bleh. This is because the ccache contains a
 # DER-encoded krb5 Ticket structure, whereas Webathena deserializes
@@ -17,102 +44,141 @@ from tempfile import NamedTemporaryFile
 # there is already an ASN.1 implementation, but in the interest of
 # limiting MIT Kerberos's exposure to malformed ccaches, encode it
 # ourselves. To that end, here's the laziest DER encoder ever.
-def _der_encode_length(l: int) -> bytes:
+def _put_der_header(buf: bytearray, pos: int, tag: int, end: int) -> int:
+    """
+    Writes the tag and length of a value that has already been written
+    between `pos` and `end`
+    """
+    l = end - pos
     if l <= 127:
-        return bytes([l])
-    out: bytes = b""
+        buf[pos - 2] = tag
+        buf[pos - 1] = l
+        return pos - 2
+    start = pos
     while l > 0:
-        out = bytes([l & 0xff]) + out
+        start -= 1
+        buf[start] = l & 0xff
         l >>= 8
-    out = bytes([len(out) | 0x80]) + out
-    return out
-
-def _der_encode_tlv(tag: int, value) -> bytes:
-    return bytes([tag]) + _der_encode_length(len(value)) + value
+    buf[start - 1] = (pos - start) | 0x80
+    buf[start - 2] = tag
+    return start - 2
 
-def _der_encode_integer_value(val: int) -> bytes:
+def _put_der_integer(buf: bytearray, pos: int, val: int) -> int:
     # base 256, MSB first, two's complement, minimum number of octets
     # necessary. This has a number of annoying edge cases:
     # * 0 and -1 are 0x00 and 0xFF, not the empty string.
     # * 255 is 0x00 0xFF, not 0xFF
     # * -256 is 0xFF 0x00, not 0x00
-
-    # Special-case to avoid an empty encoding.
+    end = pos
     if val == 0:
-        return b"\x00"
-    sign = 0 # What you would get if you sign-extended the current high bit.
-    out: bytes = b""
-    # We can stop once sign-extension matches the remaining value.
-    while val != sign:
-        byte = val & 0xff
-        out = bytes([byte]) + out
-        sign = -1 if byte & 0x80 == 0x80 else 0
-        val >>= 8
-    return out
-
-def _der_encode_integer(val: int) -> bytes:
-    return _der_encode_tlv(0x02, _der_encode_integer_value(val))
-def _der_encode_int32(val: int) -> bytes:
+        # Special-case to avoid an empty encoding.
+        pos -= 1
+        buf[pos] = 0
+    else:
+        sign = 0 # What you would get if you sign-extended the current high bit.
+        # We can stop once sign-extension matches the remaining value.
+        while val != sign:
+            byte = val & 0xff
+            pos -= 1
+            buf[pos] = byte
+            sign = -1 if byte & 0x80 == 0x80 else 0
+            val >>= 8
+    return _put_der_header(buf, pos, 0x02, end)
+
+def _put_der_int32(buf: bytearray, pos: int, val: int) -> int:
     if val < -2147483648 or val > 2147483647:
         raise ValueError("Bad value")
-    return _der_encode_integer(val)
-def _der_encode_uint32(val: int) -> bytes:
+    return _put_der_integer(buf, pos, val)
+
+def _put_der_uint32(buf: bytearray, pos: int, val: int) -> int:
     if val < 0 or val > 4294967295:
         raise ValueError("Bad value")
-    return _der_encode_integer(val)
-
-def _der_encode_string(val: str) -> bytes:
-    return _der_encode_tlv(0x1b, val.encode("utf-8"))
-
-def _der_encode_octet_bytes(val: bytes) -> bytes:
-    return _der_encode_tlv(0x04, val)
-
-def _der_encode_sequence(tlvs: list[bytes | None], tagged: bool=True) -> bytes:
-    body: list[bytes] = []
-    for i, tlv in enumerate(tlvs):
-        # Missing optional elements represented as None.
-        if not tlv:
-            continue
-        if tagged:
-            # Assume kerberos-style explicit tagging of components.
-            tlv = _der_encode_tlv(0xa0 | i, tlv)
-        body.append(tlv)
-    return _der_encode_tlv(0x30, b"".join(body))
-
-def _der_encode_ticket(tkt: dict) -> bytes:
-    return _der_encode_tlv(
-        0x61, # Ticket
-        _der_encode_sequence(
-            [_der_encode_integer(5), # tktVno
-             _der_encode_string(tkt["realm"]),
-             _der_encode_sequence( # PrincipalName
-                    [_der_encode_int32(tkt["sname"]["nameType"]),
-                     _der_encode_sequence([_der_encode_string(c)
-                                          for c in tkt["sname"]["nameString"]],
-                                         tagged=False)]),
-             _der_encode_sequence( # EncryptedData
-                    [_der_encode_int32(tkt["encPart"]["etype"]),
-                     (_der_encode_uint32(tkt["encPart"]["kvno"])
-                      if "kvno" in tkt["encPart"]
-                      else None),
-                     _der_encode_octet_bytes(
-                                base64.b64decode(tkt["encPart"]["cipher"]))])]))
+    return _put_der_integer(buf, pos, val)
+
+def _put_der_string(buf: bytearray, pos: int, val: str) -> int:
+    end = pos
+    pos = _put_bytes(buf, pos, val.encode("utf-8"))
+    return _put_der_header(buf, pos, 0x1b, end)
+
+def _put_der_octet_bytes(buf: bytearray, pos: int, val: bytes) -> int:
+    end = pos
+    pos = _put_bytes(buf, pos, val)
+    return _put_der_header(buf, pos, 0x04, end)
+
+def _put_der_ticket(buf: bytearray, pos: int, tkt: dict) -> int:
+    # Components are written last to first. Sequence components use
+    # kerberos-style explicit tagging ([0], [1], ...), except for the
+    # strings of a PrincipalName.
+    ticket_end = pos
+
+    # [3] encPart: EncryptedData
+    enc_part = tkt["encPart"]
+    tagged_end = pos
+    seq_end = pos
+    end = pos
+    pos = _put_der_octet_bytes(buf, pos, base64.b64decode(enc_part["cipher"]))
+    pos = _put_der_header(buf, pos, 0xa2, end)
+    if "kvno" in enc_part:
+        end = pos
+        pos = _put_der_uint32(buf, pos, enc_part["kvno"])
+        pos = _put_der_header(buf, pos, 0xa1, end)
+    end = pos
+    pos = _put_der_int32(buf, pos, enc_part["etype"])
+    pos = _put_der_header(buf, pos, 0xa0, end)
+    pos = _put_der_header(buf, pos, 0x30, seq_end)
+    pos = _put_der_header(buf, pos, 0xa3, tagged_end)
+
+    # [2] sname: PrincipalName
+    sname = tkt["sname"]
+    tagged_end = pos
+    seq_end = pos
+    end = pos
+    for c in reversed(sname["nameString"]):
+        pos = _put_der_string(buf, pos, c)
+    pos = _put_der_header(buf, pos, 0x30, end)
+    pos = _put_der_header(buf, pos, 0xa1, end)
+    end = pos
+    pos = _put_der_int32(buf, pos, sname["nameType"])
+    pos = _put_der_header(buf, pos, 0xa0, end)
+    pos = _put_der_header(buf, pos, 0x30, seq_end)
+    pos = _put_der_header(buf, pos, 0xa2, tagged_end)
+
+    # [1] realm
+    end = pos
+    pos = _put_der_string(buf, pos, tkt["realm"])
+    pos = _put_der_header(buf, pos, 0xa1, end)
+
+    # [0] tktVno
+    end = pos
+    pos = _put_der_integer(buf, pos, 5)
+    pos = _put_der_header(buf, pos, 0xa0, end)
+
+    pos = _put_der_header(buf, pos, 0x30, ticket_end)
+    return _put_der_header(buf, pos, 0x61, ticket_end) # Ticket
 
 # Kerberos ccache writing code. Using format documentation from here:
 # http://www.gnu.org/software/shishi/manual/html_node/The-Credential-Cache-Binary-File-Format.html
 
-def _ccache_counted_octet_bytes(data: bytes) -> bytes:
-    return struct.pack("!I", len(data)) + data
-
-def _ccache_principal(name: dict, realm: str) -> bytes:
-    header: bytes = struct.pack("!II", name["nameType"], len(name["nameString"]))
-    return (header + _ccache_counted_octet_bytes(realm.encode('utf-8')) +
-            b"".join(_ccache_counted_octet_bytes(c.encode("utf-8"))
-                    for c in name["nameString"]))
-
-def _ccache_key(key: dict) -> bytes:
-    return (struct.pack("!H", key["keytype"]) +
-            _ccache_counted_octet_bytes(base64.b64decode(key["keyvalue"])))
+def _put_ccache_counted_octet_bytes(buf: bytearray, pos: int, data: bytes) -> int:
+    pos = _put_bytes(buf, pos, data)
+    pos -= 4
+    _U32.pack_into(buf, pos, len(data))
+    return pos
+
+def _put_ccache_principal(buf: bytearray, pos: int, name: dict, realm: str) -> int:
+    components = name["nameString"]
+    for c in reversed(components):
+        pos = _put_ccache_counted_octet_bytes(buf, pos, c.encode("utf-8"))
+    pos = _put_ccache_counted_octet_bytes(buf, pos, realm.encode("utf-8"))
+    pos -= _PRINCIPAL_HEADER.size
+    _PRINCIPAL_HEADER.pack_into(buf, pos, name["nameType"], len(components))
+    return pos
+
+def _put_ccache_key(buf: bytearray, pos: int, key: dict) -> int:
+    pos = _put_ccache_counted_octet_bytes(buf, pos, base64.b64decode(key["keyvalue"]))
+    pos -= 2
+    _U16.pack_into(buf, pos, key["keytype"])
+    return pos
 
 def _flags_to_uint32(flags: list) -> int:
     ret = 0
@@ -121,34 +187,59 @@ def _flags_to_uint32(flags: list) -> int:
             ret |= 1 << (31 - i)
     return ret
 
-def _ccache_credential(cred: dict) -> bytes:
-    out: bytes = _ccache_principal(cred["cname"], cred["crealm"])
-    out += _ccache_principal(cred["sname"], cred["srealm"])
-    out += _ccache_key(cred["key"])
-    out += struct.pack("!IIII",
-                       cred["authtime"] // 1000,
-                       cred.get("starttime", cred["authtime"]) // 1000,
-                       cred["endtime"] // 1000,
-                       cred.get("renewTill", 0) // 1000)
-    out += struct.pack("!B", 0)
-    out += struct.pack("!I", _flags_to_uint32(cred["flags"]))
-    # TODO: Care about addrs or authdata? Former is "caddr" key.
-    out += struct.pack("!II", 0, 0)
-    out += _ccache_counted_octet_bytes(_der_encode_ticket(cred["ticket"]))
+def _put_ccache_credential(buf: bytearray, pos: int, cred: dict) -> int:
     # No second_ticket.
-    out += _ccache_counted_octet_bytes(b"")
-    return out
+    pos -= 4
+    _U32.pack_into(buf, pos, 0)
+    ticket_end = pos
+    pos = _put_der_ticket(buf, pos, cred["ticket"])
+    pos -= 4
+    _U32.pack_into(buf, pos, ticket_end - pos - 4)
+    # TODO: Care about addrs or authdata? Former is "caddr" key.
+    pos -= _CREDENTIAL_FLAGS.size
+    _CREDENTIAL_FLAGS.pack_into(buf, pos, 0, _flags_to_uint32(cred["flags"]), 0, 0)
+    pos -= _TIMES.size
+    _TIMES.pack_into(buf, pos,
+                     cred["authtime"] // 1000,
+                     cred.get("starttime", cred["authtime"]) // 1000,
+                     cred["endtime"] // 1000,
+                     cred.get("renewTill", 0) // 1000)
+    pos = _put_ccache_key(buf, pos, cred["key"])
+    pos = _put_ccache_principal(buf, pos, cred["sname"], cred["srealm"])
+    return _put_ccache_principal(buf, pos, cred["cname"], cred["crealm"])
+
+def _size_bound(cred: dict) -> int:
+    """
+    Upper bound of the size of the ccache for this credential
+    (strings are counted in characters, which is at least 1/4 of
+    their length in UTF-8)
+    """
+    tkt = cred["ticket"]
+    items = [cred["crealm"], cred["srealm"], tkt["realm"]]
+    # The client principal is written twice
+    items += cred["cname"]["nameString"] * 2
+    items += cred["sname"]["nameString"]
+    items += tkt["sname"]["nameString"]
+    size = _FIXED_OVERHEAD + len(items) * _ITEM_OVERHEAD
+    size += 4 * sum(len(item) for item in items)
+    # base64 is longer than what it decodes to
+    size += len(cred["key"]["keyvalue"]) + len(tkt["encPart"]["cipher"])
+    return size
 
 def make_ccache(cred: dict) -> bytes:
+    buf = bytearray(_size_bound(cred))
+    pos = _put_ccache_credential(buf, len(buf), cred)
+    pos = _put_ccache_principal(buf, pos, cred["cname"], cred["crealm"])
     # Do we need a DeltaTime header? The ccache I get just puts zero
     # in there, so do the same.
-    out: bytes = struct.pack("!HHHHII",
+    pos -= _HEADER.size
+    _HEADER.pack_into(buf, pos,
                       0x0504, # file_format_version
                       12, # headerlen
                       1, # tag (DeltaTime)
                       8, # taglen (two uint32_ts)
                       0, 0, # time_offset / usec_offset
                       )
-    out += _ccache_principal(cred["cname"], cred["crealm"])
-    out += _ccache_credential(cred)
-    return out
+    # Writing past the start would have wrapped around to the end
+    assert pos >= 0
+    return bytes(memoryview(buf)[pos:])
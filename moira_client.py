@@ -0,0 +1,522 @@
+"""
+Python client for this API, so scripts don't have to hand-write HTTP calls.
+
+    from moira_client import MoiraClient
+
+    client = MoiraClient('https://moira-api.mit.edu', webathena=token)
+    client.get_list_members('my-list')
+
+    # Many calls in one round trip (if the server has POST /batch)
+    with client.batch():
+        infos = [client.get_list(name) for name in names]
+    infos = [info.result() for info in infos]
+
+It keeps one HTTP connection open per thread, encodes the webathena header once,
+and remembers the ETag of each GET result, so that unchanged results are not
+downloaded again. Only uses the standard library.
+
+Changes can be made in the background by passing `respond_async=True` (see
+"Asynchronous writes" in the README): they return the job, whose status
+`get_job` gives.
+
+Errors from the API are raised as MoiraAPIError.
+"""
+
+import base64
+import http.client
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+# How many GET results to keep for revalidation with ETags
+ETAG_CACHE_SIZE = 256
+
+# Same as api.MAX_BATCH_SIZE
+MAX_BATCH_SIZE = 100
+
+
+class MoiraAPIError(Exception):
+    """
+    An error returned by the API (see "Errors" in the README)
+    """
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        if isinstance(body, dict):
+            error = body.get('error', body)
+            self.code = error.get('code')
+            self.name = error.get('name')
+            message = error.get('message') or error.get('description')
+        else:
+            self.code = None
+            self.name = None
+            message = body
+        super().__init__(f'{status} {self.name or "error"}: {message}')
+
+
+class BatchResult:
+    """
+    Result of a call made inside `with client.batch():`, available once the batch is sent
+    """
+
+    def __init__(self):
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def _set(self, value=None, error=None):
+        self._done = True
+        self._value = value
+        self._error = error
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('the batch has not been sent yet')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class _Batch:
+    def __init__(self, client):
+        self.client = client
+        # (method, path, body, BatchResult)
+        self.calls = []
+
+    def __enter__(self):
+        if getattr(self.client._local, 'batch', None) is not None:
+            raise RuntimeError('batches can not be nested')
+        self.client._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.client._local.batch = None
+        if exc_type is None:
+            self.flush()
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        for start in range(0, len(calls), MAX_BATCH_SIZE):
+            self.client._send_batch(calls[start:start + MAX_BATCH_SIZE])
+
+
+def _parse_body(response, data):
+    if response.getheader('Content-Type', '').startswith('application/json'):
+        return json.loads(data) if data else None
+    return data.decode()
+
+
+def _next_link(response):
+    """
+    The URL of the next page, from a `Link: <...>; rel="next"` header
+    """
+    for link in response.getheader('Link', '').split(','):
+        url, _, params = link.partition(';')
+        if 'rel="next"' in params.replace(' ', ''):
+            return url.strip().strip('<>')
+    return None
+
+
+class MoiraClient:
+    """
+    Client for the Moira REST API.
+
+    `webathena` is the credential from webathena, either as a dict or already
+    base64-encoded. If `modwith` is given, Moira will show it as the app that
+    made the changes. `timeout` (in seconds) is sent as Request-Timeout.
+    """
+
+    def __init__(self, base_url, webathena=None, modwith=None, timeout=None):
+        url = urllib.parse.urlsplit(base_url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._netloc = url.netloc
+        self._prefix = url.path.rstrip('/')
+        self._timeout = timeout
+
+        self._headers = {'Accept': 'application/json'}
+        if webathena is not None:
+            if not isinstance(webathena, str):
+                webathena = base64.b64encode(json.dumps(webathena).encode()).decode()
+            self._headers['Authorization'] = f'webathena {webathena}'
+        if modwith is not None:
+            self._headers['modwith'] = modwith
+        if timeout is not None:
+            self._headers['Request-Timeout'] = str(timeout)
+
+        # Connections can't be shared between threads
+        self._local = threading.local()
+        # URL -> (ETag, parsed body)
+        self._etags = OrderedDict()
+        self._etags_lock = threading.Lock()
+        # None until we know if the server has POST /batch
+        self._batch_supported = None
+
+    # Plumbing
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Leave some time for the server to time out on its own
+            timeout = self._timeout + 10 if self._timeout else None
+            connection = self._connection_class(self._netloc, timeout=timeout)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        """
+        Closes this thread's connection (it is reopened if needed)
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _send(self, method, url, body=None, headers=None, stream=False):
+        """
+        Sends a request on this thread's connection, and returns the response
+        (read, unless streaming). Reconnects once if the server had closed the
+        connection in the meantime.
+        """
+        headers = {**self._headers, **(headers or {})}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, url, payload, headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if stream:
+                # The connection can't be reused until the stream is over
+                self._local.connection = None
+                return response, None
+            data = response.read()
+            if response.will_close:
+                self.close()
+            return response, data
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        """
+        Makes a request to the API and returns the parsed result.
+        Inside `with client.batch():`, returns a BatchResult instead
+        (batched calls can't have headers of their own).
+        """
+        url = self._url(path, params)
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            if headers:
+                raise ValueError('batched calls can not send headers of their own')
+            result = BatchResult()
+            batch.calls.append((method, url, body, result))
+            return result
+        return self._request(method, url, body, headers)
+
+    def _url(self, path, params=None):
+        url = self._prefix + path
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+            url += '?' + urllib.parse.urlencode(params, doseq=True)
+        return url
+
+    def _request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        cached = None
+        if method == 'GET':
+            with self._etags_lock:
+                cached = self._etags.get(url)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+
+        response, data = self._send(method, url, body, headers)
+        if response.status == 304 and cached is not None:
+            with self._etags_lock:
+                if url in self._etags:
+                    self._etags.move_to_end(url)
+            return cached[1]
+        result = _parse_body(response, data)
+        if response.status >= 400 or (isinstance(result, dict) and result.get('name') == 'METHOD_NOT_FOUND'):
+            raise MoiraAPIError(response.status, result)
+
+        etag = response.getheader('ETag')
+        if method == 'GET' and etag:
+            with self._etags_lock:
+                self._etags[url] = (etag, result)
+                self._etags.move_to_end(url)
+                while len(self._etags) > ETAG_CACHE_SIZE:
+                    self._etags.popitem(last=False)
+        return result
+
+    def pages(self, path, params=None):
+        """
+        Iterates over the items of a list result, following `Link: rel="next"`
+        headers if the server splits the result into pages
+        """
+        url = self._url(path, params)
+        while url:
+            response, data = self._send('GET', url)
+            result = _parse_body(response, data)
+            if response.status >= 400:
+                raise MoiraAPIError(response.status, result)
+            yield from result
+            url = _next_link(response)
+
+    def batch(self):
+        """
+        Groups the calls made inside `with client.batch():` (in this thread)
+        into as few requests as possible. The calls return BatchResults.
+
+        If the server doesn't support batches, the calls are made one by one
+        (on the same connection) when the `with` block ends.
+        """
+        return _Batch(self)
+
+    def _send_batch(self, calls):
+        if self._batch_supported is not False:
+            try:
+                result = self._request('POST', self._url('/batch'), {
+                    'requests': [
+                        {'method': method, 'path': url[len(self._prefix):], 'body': body}
+                        for method, url, body, _ in calls
+                    ],
+                })
+                self._batch_supported = True
+            except MoiraAPIError as e:
+                if e.name not in ('METHOD_NOT_FOUND', 'METHOD_NOT_ALLOWED') and e.status not in (404, 405):
+                    raise
+                self._batch_supported = False
+            else:
+                for (_, _, _, batch_result), response in zip(calls, result['responses']):
+                    body = response['body']
+                    if response['status'] >= 400:
+                        batch_result._set(error=MoiraAPIError(response['status'], body))
+                    else:
+                        batch_result._set(body)
+                return
+        for method, url, body, batch_result in calls:
+            try:
+                batch_result._set(self._request(method, url, body))
+            except MoiraAPIError as e:
+                batch_result._set(error=e)
+
+    def stream_events(self, path, params=None):
+        """
+        Yields (event, data) for each Server-Sent Event of the response,
+        on a connection of its own
+        """
+        response, _ = self._send('GET', self._url(path, params), headers={'Accept': 'text/event-stream'}, stream=True)
+        if response.status >= 400:
+            raise MoiraAPIError(response.status, _parse_body(response, response.read()))
+        try:
+            event, data = 'message', []
+            for line in response:
+                line = line.decode().rstrip('\r\n')
+                if not line:
+                    if data:
+                        yield event, json.loads('\n'.join(data))
+                    event, data = 'message', []
+                elif line.startswith(':'):
+                    continue
+                elif line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data.append(line[len('data:'):].strip())
+        finally:
+            response.close()
+
+    def stream_lines(self, method, path, params=None, body=None):
+        """
+        Yields each line of a JSON Lines response, parsed, on a connection of its own
+        """
+        response, _ = self._send(method, self._url(path, params), body, stream=True)
+        if response.status >= 400:
+            raise MoiraAPIError(response.status, _parse_body(response, response.read()))
+        try:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    # Debugging
+
+    def whoami(self):
+        return self.request('GET', '/whoami')
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+    def raw_query(self, query, *args):
+        return self.request('GET', f'/raw_query/{_quote(query)}', {'arg': list(args)})
+
+    # Users
+
+    def get_user(self, user='me'):
+        return self.request('GET', f'/users/{_quote(user)}/')
+
+    def get_user_belongings(self, user='me', recurse=True):
+        return self.request('GET', f'/users/{_quote(user)}/belongings', {'recurse': _bool(recurse)})
+
+    def get_user_lists(self, user='me', recurse=True, include_properties=False, expand=None):
+        return self.request('GET', f'/users/{_quote(user)}/lists', {
+            'recurse': _bool(recurse),
+            'include_properties': _bool(include_properties),
+            'expand': _expand(expand),
+        })
+
+    def get_user_tapaccess(self, user='me'):
+        return self.request('GET', f'/users/{_quote(user)}/tapaccess')
+
+    def get_finger(self, user='me'):
+        return self.request('GET', f'/users/{_quote(user)}/finger')
+
+    def update_finger(self, user='me', **fields):
+        return self.request('PATCH', f'/users/{_quote(user)}/finger', body=fields)
+
+    # Lists
+
+    def get_lists(self, **filters):
+        """
+        All lists matching the filters (active, public, hidden, is_mailing_list, is_afs_group)
+        """
+        return list(self.pages('/lists/', {'confirm': 'true', **_filters(filters)}))
+
+    def search_lists(self, q, limit=None, substring=True, **filters):
+        return self.request('GET', '/lists/search', {
+            'q': q, 'limit': limit, 'substring': _bool(substring), **_filters(filters),
+        })
+
+    def get_list(self, list_name):
+        return self.request('GET', f'/lists/{_quote(list_name)}/')
+
+    def update_list(self, list_name, respond_async=False, **attributes):
+        return self.request('PATCH', f'/lists/{_quote(list_name)}/', body=attributes,
+                            headers=_prefer(respond_async))
+
+    def delete_list(self, list_name):
+        return self.request('DELETE', f'/lists/{_quote(list_name)}/')
+
+    def get_list_members(self, list_name, recurse=False, expand=None):
+        """
+        Members of a list. `expand` adds fields to them, e.g. ['lists.owner', 'users.info']
+        (see "Expanding results" in the README)
+        """
+        return self.request('GET', f'/lists/{_quote(list_name)}/members/', {
+            'recurse': _bool(recurse),
+            'expand': _expand(expand),
+        })
+
+    def add_member(self, list_name, member_name, member_type='user', respond_async=False):
+        return self.request('PUT', f'/lists/{_quote(list_name)}/members/{_quote(member_name)}', {'type': member_type},
+                            headers=_prefer(respond_async))
+
+    def remove_member(self, list_name, member_name, member_type='user', respond_async=False):
+        return self.request('DELETE', f'/lists/{_quote(list_name)}/members/{_quote(member_name)}', {'type': member_type},
+                            headers=_prefer(respond_async))
+
+    def get_list_belongings(self, list_name, recurse=True):
+        return self.request('GET', f'/lists/{_quote(list_name)}/belongings', {'recurse': _bool(recurse)})
+
+    def get_list_lists(self, list_name, recurse=True, include_properties=False, expand=None):
+        return self.request('GET', f'/lists/{_quote(list_name)}/lists', {
+            'recurse': _bool(recurse),
+            'include_properties': _bool(include_properties),
+            'expand': _expand(expand),
+        })
+
+    def get_owner(self, list_name):
+        return self.request('GET', f'/lists/{_quote(list_name)}/owner')
+
+    def set_owner(self, list_name, owner_type, owner_name, respond_async=False):
+        return self.request('PUT', f'/lists/{_quote(list_name)}/owner', body={'type': owner_type, 'name': owner_name},
+                            headers=_prefer(respond_async))
+
+    def get_membership_admin(self, list_name):
+        return self.request('GET', f'/lists/{_quote(list_name)}/membership_admin')
+
+    def set_membership_admin(self, list_name, admin_type, admin_name, respond_async=False):
+        return self.request('PUT', f'/lists/{_quote(list_name)}/membership_admin',
+                            body={'type': admin_type, 'name': admin_name}, headers=_prefer(respond_async))
+
+    def delete_membership_admin(self, list_name, respond_async=False):
+        return self.request('DELETE', f'/lists/{_quote(list_name)}/membership_admin', headers=_prefer(respond_async))
+
+    def setops(self, expression, recurse=None, count_only=None, stream=False):
+        """
+        Combines the members of several lists on the server (see "Compare lists" in the README),
+        e.g. `client.setops({'difference': ['list-a', {'union': ['list-b', 'list-c']}]})`.
+        With `stream=True`, yields `{"type": ..., "name": ...}` for each member instead.
+        """
+        body = {'expression': expression, 'recurse': recurse, 'count_only': count_only}
+        body = {k: v for k, v in body.items() if v is not None}
+        if stream:
+            return self.stream_lines('POST', '/lists/_setops', body={**body, 'stream': True})
+        return self.request('POST', '/lists/_setops', body=body)
+
+    def watch(self, *list_names):
+        """
+        Yields (event, data) for changes to the given lists (see "Watch lists for changes" in the README)
+        """
+        if len(list_names) == 1:
+            return self.stream_events(f'/lists/{_quote(list_names[0])}/watch')
+        return self.stream_events('/lists/watch', {'list': list(list_names)})
+
+    # Jobs
+
+    def get_job(self, job_id):
+        """
+        Status (and result, once it is over) of a change made with `respond_async=True`
+        """
+        return self.request('GET', f'/jobs/{_quote(job_id)}')
+
+    # Mailman
+
+    def mailman_subscribe(self, list_name):
+        return self.request('POST', f'/mailman/{_quote(list_name)}/request_subscription')
+
+    def mailman_unsubscribe(self, list_name):
+        return self.request('POST', f'/mailman/{_quote(list_name)}/request_unsubscription')
+
+
+def _quote(segment):
+    return urllib.parse.quote(segment, safe='')
+
+
+def _bool(value):
+    return None if value is None else str(bool(value)).lower()
+
+
+def _expand(expand):
+    """
+    The expand parameter, from a comma-separated string or a list of paths
+    """
+    if expand is None or isinstance(expand, str):
+        return expand
+    return ','.join(expand)
+
+
+def _prefer(respond_async):
+    """
+    Headers asking the API to make a change in the background (see "Asynchronous writes" in the README)
+    """
+    return {'Prefer': 'respond-async'} if respond_async else None
+
+
+def _filters(filters):
+    return {name: _bool(value) for name, value in filters.items()}
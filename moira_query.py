@@ -1,31 +1,132 @@
-import moira
 import concurrent.futures
+import contextvars
+import multiprocessing
+import os
+from tempfile import NamedTemporaryFile
+from admission import admit
+from deadlines import DeadlineExceeded, time_left
+import timing
+import profiling
+from query_cache import invalidate_for, note_authenticated
 
 CLIENT_NAME = 'python3'
 
-def _moira_query(modwith, *args, **kwargs):
+# Start method of the worker processes ("fork", "forkserver" or "spawn"),
+# or the platform default if unset
+START_METHOD = os.environ.get('MOIRA_WORKER_START_METHOD')
+
+# Credential cache file of the current request (set by decorators.webathena).
+# It can't go in os.environ, which every thread of the process shares.
+current_ccache: contextvars.ContextVar[str | None] = contextvars.ContextVar('current_ccache', default=None)
+
+
+def ccache_env():
     """
-    Runs the given Moira query, taking care to do all necessary 
-    initialization and de-initialization
+    Environment for running Kerberos programs (klist, msmtp...) with the
+    credential cache of the current request, or None (i.e. os.environ)
+    outside of one
     """
-    moira.connect()
-    moira.auth(modwith)
-    result = moira.query(*args, **kwargs)
-    moira.disconnect()
-    return result
+    ccache = current_ccache.get()
+    return {**os.environ, 'KRB5CCNAME': ccache} if ccache else None
+
+_mp_context = None
+
+def _get_mp_context():
+    global _mp_context
+    if _mp_context is None:
+        _mp_context = multiprocessing.get_context(START_METHOD)
+        if _mp_context.get_start_method() == 'forkserver':
+            _mp_context.set_forkserver_preload(['moira_worker'])
+    return _mp_context
+
+
+def _run_in_new_process(ccache_name, modwith, *args, **kwargs):
+    """
+    Runs the given query in a new process (see moira_worker.moira_query),
+    once admission control lets us, and gives up (killing the process)
+    if the request deadline passes
+    """
+    query = args[0]
+    with admit(query, timeout=time_left()):
+        timeout = time_left()
+        if timeout <= 0:
+            raise DeadlineExceeded(query, 0)
+        # Whatever is not spent in the worker's own steps is the cost
+        # of starting it and passing data around
+        with timing.span('executor'):
+            # Imported here so that the moira module is only loaded once
+            # it is needed (forked workers inherit it from then on)
+            import moira_worker
+            executor = concurrent.futures.ProcessPoolExecutor(mp_context=_get_mp_context())
+            profile_mode = profiling.worker_mode()
+            try:
+                if profile_mode is None:
+                    f = executor.submit(moira_worker.moira_query, ccache_name, modwith, *args, **kwargs)
+                else:
+                    f = executor.submit(moira_worker.moira_query_profiled, profile_mode,
+                                        ccache_name, modwith, *args, **kwargs)
+                try:
+                    result, timings, *profile = f.result(timeout=timeout)
+                except concurrent.futures.TimeoutError:
+                    # There is no public API to stop a running worker (before 3.14)
+                    for process in executor._processes.values():
+                        process.kill()
+                    raise DeadlineExceeded(query, timeout)
+            finally:
+                executor.shutdown()
+            for name, seconds in timings:
+                timing.add(name, seconds)
+            if profile:
+                profiling.add_worker_profile(profile[0])
+        return result
+
+
+# Functions called with (query, args, kwargs) after every successful query
+# (e.g. to find out about writes)
+after_query_hooks = []
+
+def _after_query(args, kwargs):
+    # Moira accepted the credential, so cached results may be served to it
+    note_authenticated()
+    # If it was a write, cached results may be out of date now
+    invalidate_for(args[0])
+    for hook in after_query_hooks:
+        hook(args[0], args[1:], kwargs)
 
 
 def moira_query_modwith(modwith=None, *args, **kwargs):
     """
-    Runs the given Moira query in a new process, so that
-    environment variable changes (KRB5CCNAME) are actually honored,
+    Runs the given Moira query in a new process, authenticated with the
+    credential cache of the current request (or KRB5CCNAME if there is none),
     and allow changing the modwith
     """
     # https://stackoverflow.com/a/72490867/5031798
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        f = executor.submit(_moira_query, modwith, *args, **kwargs)
-        ret = f.result()
-    return ret
+    # Pass the ccache explicitly, since workers started by a forkserver
+    # don't inherit our environment
+    ccache_name = current_ccache.get() or os.environ.get('KRB5CCNAME')
+    result = _run_in_new_process(ccache_name, modwith, *args, **kwargs)
+    _after_query(args, kwargs)
+    return result
+
+
+def moira_query_cred(cred, modwith=None, *args, **kwargs):
+    """
+    Runs the given Moira query in a new process, authenticated with the
+    given credential (the ccache made from the user's webathena token, see
+    decorators.webathena) instead of the request's ccache file.
+
+    This does not need the ccache file to still exist, so it is safe to use
+    outside of a request (e.g. from a background thread). If `cred` is None,
+    it behaves like moira_query_modwith.
+    """
+    if cred is None:
+        return moira_query_modwith(modwith, *args, **kwargs)
+    with NamedTemporaryFile(prefix='ccache_') as ccache:
+        ccache.write(cred)
+        ccache.flush()
+        result = _run_in_new_process(ccache.name, modwith, *args, **kwargs)
+    _after_query(args, kwargs)
+    return result
 
 
 def moira_query(*args, **kwargs):
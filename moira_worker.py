@@ -0,0 +1,68 @@
+"""
+Code that runs in the Moira worker processes (see moira_query).
+
+It is kept in its own module, without Flask or any other API code,
+so that worker processes that have to import it (i.e. when not using
+the "fork" start method) start quickly.
+"""
+
+import os
+import time
+
+import moira
+
+
+def moira_query(ccache_name, modwith, *args, **kwargs):
+    """
+    Runs the given Moira query, taking care to do all necessary 
+    initialization and de-initialization
+
+    If `ccache_name` is given, the query is authenticated with that
+    credential cache (otherwise, whatever KRB5CCNAME already says).
+
+    Returns the result, and how long each step took (since this runs
+    in another process, see timing.add)
+    """
+    if ccache_name is not None:
+        os.environ['KRB5CCNAME'] = ccache_name
+    timings = []
+    start = time.perf_counter()
+    moira.connect()
+    timings.append(('moira.connect', time.perf_counter() - start))
+    start = time.perf_counter()
+    moira.auth(modwith)
+    timings.append(('moira.auth', time.perf_counter() - start))
+    start = time.perf_counter()
+    result = moira.query(*args, **kwargs)
+    timings.append(('moira.query', time.perf_counter() - start))
+    start = time.perf_counter()
+    moira.disconnect()
+    timings.append(('moira.disconnect', time.perf_counter() - start))
+    return result, timings
+
+
+def moira_query_profiled(mode, ccache_name, modwith, *args, **kwargs):
+    """
+    Like moira_query, but also profiles it (see profiling), with
+    cProfile or tracemalloc depending on `mode`.
+
+    Returns the result, the timings and the profile: the cProfile stats,
+    or the lines that allocated the most memory
+    """
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        result, timings = profiler.runcall(moira_query, ccache_name, modwith, *args, **kwargs)
+        profiler.create_stats()
+        return result, timings, profiler.stats
+
+    import tracemalloc
+    tracemalloc.start(25)
+    # Forked workers inherit the traces of the web process if it was tracing too
+    tracemalloc.clear_traces()
+    try:
+        result, timings = moira_query(ccache_name, modwith, *args, **kwargs)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return result, timings, [str(stat) for stat in snapshot.statistics('lineno')[:50]]
@@ -0,0 +1,216 @@
+"""
+On-demand profiling of requests, to find out why a route is slow in
+production without redeploying.
+
+Admins (MOIRA_PROFILE_ADMINS, a comma-separated list of kerbs) may add
+`?profile=cprofile` (a cProfile call tree) or `?profile=alloc` (the
+lines that allocated the most memory, from tracemalloc) to any request.
+They get the report instead of the usual response. Since webathena
+credentials aren't checked by this API, the report is only returned if
+one of the request's Moira queries authenticated successfully.
+
+Requests may also be sampled: with MOIRA_PROFILE_SAMPLE=N, 1 in N requests
+is profiled with cProfile. Reports are saved in MOIRA_PROFILE_DIR (admin
+reports too), keeping the newest MOIRA_PROFILE_KEEP.
+
+The work done in Moira worker processes is profiled too (see
+moira_worker.moira_query_profiled) and merged into the report.
+
+If no admins are set and sampling is off, nothing is installed, so this
+costs nothing.
+"""
+
+import contextvars
+import io
+import itertools
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+
+from flask import g, make_response, request
+
+from admission import current_principal
+
+ADMINS = {kerb for kerb in os.environ.get('MOIRA_PROFILE_ADMINS', '').split(',') if kerb}
+SAMPLE_EVERY = int(os.environ.get('MOIRA_PROFILE_SAMPLE', 0))
+ARCHIVE_DIR = os.environ.get('MOIRA_PROFILE_DIR', 'profiles')
+ARCHIVE_KEEP = int(os.environ.get('MOIRA_PROFILE_KEEP', 100))
+
+MODES = ('cprofile', 'alloc')
+
+# Lines in reports
+REPORT_LINES = 50
+
+# Profile mode of the current request, for Moira worker processes
+_mode: contextvars.ContextVar[str | None] = contextvars.ContextVar('profile_mode', default=None)
+# Profiles sent back by the Moira worker processes of the current request
+_worker_profiles: contextvars.ContextVar[list | None] = contextvars.ContextVar('worker_profiles', default=None)
+
+_requests = itertools.count()
+# tracemalloc traces the whole process, so only one request at a time
+_alloc_lock = threading.Lock()
+_archive_lock = threading.Lock()
+
+
+def worker_mode():
+    """
+    How Moira worker processes should profile their query (None if they shouldn't)
+    """
+    return _mode.get()
+
+
+def add_worker_profile(profile):
+    """
+    Adds the profile made by a Moira worker process to the current request's
+    """
+    profiles = _worker_profiles.get()
+    if profiles is not None:
+        profiles.append(profile)
+
+
+class _WorkerStats:
+    """
+    Stats made by a worker's cProfile, in the form pstats.Stats.add wants
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _start():
+    mode = request.args.get('profile')
+    requested = mode in MODES
+    if requested:
+        # Only trusted once a Moira query succeeds (see _finish), but checked
+        # now so that nobody else can turn the profiler on
+        from decorators import claimed_kerb
+        requested = claimed_kerb() in ADMINS
+    if not requested:
+        if not SAMPLE_EVERY or next(_requests) % SAMPLE_EVERY:
+            return
+        mode = 'cprofile'
+
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Something else is profiling this thread
+            return
+    else:
+        if not _alloc_lock.acquire(blocking=False):
+            g.profile = (mode, None, requested)
+            return
+        import tracemalloc
+        tracemalloc.start(25)
+        profiler = tracemalloc
+    g.profile = (mode, profiler, requested)
+    _mode.set(mode)
+    _worker_profiles.set([])
+
+
+def _cprofile_report(profiler, worker_profiles):
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    for worker_stats in worker_profiles:
+        stats.add(_WorkerStats(worker_stats))
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+    return out.getvalue(), marshal.dumps(stats.stats), 'pstats'
+
+
+def _alloc_report(worker_profiles):
+    import tracemalloc
+    try:
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        _alloc_lock.release()
+    lines = ['Top allocations in the web process:']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:REPORT_LINES]]
+    for i, worker_lines in enumerate(worker_profiles):
+        lines += ['', f'Top allocations in Moira worker process {i + 1}:', *worker_lines]
+    report = '\n'.join(lines) + '\n'
+    return report, report.encode(), 'txt'
+
+
+def _archive(data, extension):
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', f'{request.method}{request.path}').strip('_')
+    filename = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{next(_requests)}-{name}.{extension}'
+    with _archive_lock:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        with open(os.path.join(ARCHIVE_DIR, filename), 'wb') as f:
+            f.write(data)
+        archived = sorted(os.listdir(ARCHIVE_DIR))
+        for old in archived[:max(0, len(archived) - ARCHIVE_KEEP)]:
+            os.remove(os.path.join(ARCHIVE_DIR, old))
+    return filename
+
+
+def _finish(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    mode, profiler, requested = profile
+    if profiler is None:
+        response.headers['X-Profile'] = 'busy'
+        return response
+    worker_profiles = _worker_profiles.get()
+    _mode.set(None)
+    _worker_profiles.set(None)
+
+    if mode == 'cprofile':
+        report, data, extension = _cprofile_report(profiler, worker_profiles)
+    else:
+        report, data, extension = _alloc_report(worker_profiles)
+
+    # Only Moira checks tickets, so only trust the kerb if it let us in
+    allowed = requested and current_principal.get() in ADMINS and worker_profiles
+    if not allowed and requested:
+        # Not an admin after all: as if the parameter wasn't there
+        return response
+    filename = _archive(data, extension)
+    if not requested:
+        return response
+    profiled = make_response(report, response.status_code)
+    profiled.mimetype = 'text/plain'
+    profiled.headers['X-Profile'] = filename
+    return profiled
+
+
+def _cleanup(exception):
+    """
+    Stops profiling if the request failed before _finish could
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    mode, profiler, _ = profile
+    _mode.set(None)
+    _worker_profiles.set(None)
+    if profiler is None:
+        return
+    if mode == 'cprofile':
+        profiler.disable()
+    else:
+        profiler.stop()
+        _alloc_lock.release()
+
+
+def init_app(app):
+    """
+    Installs the profiling hooks, if profiling is enabled
+    """
+    if not ADMINS and not SAMPLE_EVERY:
+        return
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_cleanup)
@@ -0,0 +1,200 @@
+"""
+Cache for the results of read-only queries that are made over and over
+(get_list_info, get_user_by_login, ...), through /raw_query or when
+getting list attributes. Results are stored in the cache backend (see
+cache_backend), so they may be shared by all the worker processes.
+
+Only queries in the allowlist (CACHED_QUERIES) are cached, each with its
+own TTL and maximum size. Entries are keyed on the query,
+its arguments and who can see the result: most queries are cached per
+credential, since Moira may show different things (or nothing) to different
+people. They are keyed on the credential itself (a hash of the webathena
+token), not on the kerb it claims to be, since only Moira checks tickets.
+Results that are the same for everyone are only served to credentials that
+Moira has accepted at least once.
+
+Whenever this API runs a write query, the cached results of the related
+read queries (INVALIDATED_BY) are dropped.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import uuid
+from collections import Counter
+
+from cache_backend import Namespace
+
+# Query name -> (TTL in seconds, max bytes, scope), where scope is
+# "user" if the result depends on who asks, or "global" otherwise.
+# Can be overridden with a JSON object in the RAW_QUERY_CACHE environment variable.
+CACHED_QUERIES = {
+    'get_list_info': (60, 4 * 2**20, 'user'),
+    'get_user_by_login': (300, 2 * 2**20, 'user'),
+    'get_machine': (300, 2 * 2**20, 'global'),
+}
+if 'RAW_QUERY_CACHE' in os.environ:
+    CACHED_QUERIES = {
+        query: tuple(config)
+        for query, config in json.loads(os.environ['RAW_QUERY_CACHE']).items()
+    }
+
+# Hash of the webathena token of the caller (set by decorators.webathena).
+# Outside of requests (or with no token), nothing is cached.
+current_credential: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    'current_credential', default=None
+)
+
+# Credentials that Moira accepted (see note_authenticated), for this long (in seconds)
+AUTHENTICATED_TTL = 300
+_authenticated = Namespace('authenticated', AUTHENTICATED_TTL, 2**20)
+
+_LIST_QUERIES = (
+    'get_list_info', 'qualified_get_lists',
+    'get_members_of_list', 'get_end_members_of_list', 'get_lists_of_member',
+)
+_MEMBERSHIP_QUERIES = ('get_members_of_list', 'get_end_members_of_list', 'get_lists_of_member')
+
+# Write query -> read queries whose results it may change
+INVALIDATED_BY = {
+    'update_list': _LIST_QUERIES,
+    'delete_list': _LIST_QUERIES,
+    'add_list': _LIST_QUERIES,
+    'add_member_to_list': _MEMBERSHIP_QUERIES,
+    'delete_member_from_list': _MEMBERSHIP_QUERIES,
+    'update_finger_by_login': ('get_finger_by_login',),
+    'update_user': ('get_user_by_login',),
+    'update_user_status': ('get_user_by_login',),
+    'update_user_shell': ('get_user_by_login',),
+    'add_machine': ('get_machine',),
+    'update_machine': ('get_machine',),
+    'delete_machine': ('get_machine',),
+}
+
+
+# Generation of the cached results of each query, changed (to a new random
+# value) whenever they are invalidated. It is kept in the backend, so that all
+# the processes sharing it see the change. Results are stored along with the
+# generation from before their query ran, and ignored once it changes, so
+# results of queries that were already running when the cache was
+# invalidated (in any process) are never served.
+_generations = Namespace('generations', ttl=10 * 365 * 24 * 60 * 60, max_bytes=2**16)
+
+
+def _generation(query):
+    generation = _generations.get(query)
+    if generation is None:
+        generation = _generations.add(query, uuid.uuid4().hex.encode())
+    return generation.decode()
+
+
+class _QueryCache:
+    """
+    Cached results of a single query
+    """
+
+    def __init__(self, query, ttl, max_bytes):
+        self.namespace = Namespace(f'query:{query}', ttl, max_bytes)
+
+    def get(self, key, generation):
+        value = self.namespace.get(key)
+        if value is None:
+            return None
+        stored_generation, columns, rows = json.loads(value)
+        if stored_generation != generation:
+            return None
+        return [dict(zip(columns, row)) for row in rows]
+
+    def put(self, key, result, generation):
+        # Rows of the same query have the same columns, so only keep them once
+        columns = list(result[0].keys()) if result else []
+        rows = [[row[c] for c in columns] for row in result]
+        self.namespace.set(key, json.dumps([generation, columns, rows], separators=(',', ':')).encode())
+
+
+_caches = {
+    query: _QueryCache(query, ttl, max_bytes)
+    for query, (ttl, max_bytes, _) in CACHED_QUERIES.items()
+}
+_lock = threading.Lock()
+_invalidations = Counter()
+
+
+def note_authenticated():
+    """
+    Remembers that Moira accepted the current credential
+    (called after every successful query)
+    """
+    credential = current_credential.get()
+    if credential is not None and _authenticated.get(credential) is None:
+        _authenticated.set(credential, b'1')
+
+
+def authenticated():
+    """
+    Whether Moira has accepted the current credential recently
+    """
+    credential = current_credential.get()
+    return credential is not None and _authenticated.get(credential) is not None
+
+
+def cached_query(moira_query, query, args):
+    """
+    Runs the given query through the cache (if it is in the allowlist),
+    on behalf of the current credential.
+
+    Returns the result and the cache status (HIT, MISS or BYPASS)
+    """
+    cache = _caches.get(query)
+    credential = current_credential.get()
+    if cache is None or credential is None:
+        return moira_query(query, *args), 'BYPASS'
+    if CACHED_QUERIES[query][2] == 'global':
+        key = json.dumps([None, list(args)])
+        # Anyone can make up a token, so check it with Moira first
+        usable = authenticated()
+    else:
+        # Only the same token could have put it there, and Moira accepted it then
+        key = json.dumps([credential, list(args)])
+        usable = True
+    generation = _generation(query)
+    result = cache.get(key, generation) if usable else None
+    if result is not None:
+        return result, 'HIT'
+    result = moira_query(query, *args)
+    cache.put(key, result, generation)
+    return result, 'MISS'
+
+
+def get_list_info(moira_query, list_name):
+    """
+    get_list_info of a list, through the cache (for reading list attributes).
+    Don't use it to read attributes that are about to be written back.
+    """
+    result, _ = cached_query(moira_query, 'get_list_info', [list_name])
+    return result[0]
+
+
+def invalidate_for(query):
+    """
+    Drops the cached results that the given (write) query may have changed
+    """
+    for read_query in INVALIDATED_BY.get(query, ()):
+        cache = _caches.get(read_query)
+        if cache is not None:
+            _generations.set(read_query, uuid.uuid4().hex.encode())
+            # Not needed anymore
+            cache.namespace.clear()
+            with _lock:
+                _invalidations[read_query] += 1
+
+
+def stats():
+    return {
+        query: {
+            **cache.namespace.stats(),
+            'invalidations': _invalidations[query],
+        }
+        for query, cache in _caches.items()
+    }
@@ -0,0 +1,192 @@
+"""
+Set operations over list memberships (POST /lists/_setops), for
+auditing questions like "who is on list A but not on list B" without
+downloading every list.
+
+An expression is a list name, `{"list": name, "recurse": bool}`, or
+`{"union": [...]}`, `{"intersection": [...]}` or `{"difference": [...]}`
+(the first expression minus all the others) of expressions.
+
+The lists are fetched in parallel (see expand.Loader). Their members
+are interned as integers, numbered in the order the members will be
+output, so that each list becomes a sorted array of integers and the
+operations are merges of sorted arrays.
+"""
+
+import bisect
+import heapq
+import json
+import os
+from array import array
+
+from expand import Loader
+from util import parse_bool, parse_members
+
+# Lists an expression may refer to
+MAX_LISTS = int(os.environ.get('MOIRA_SETOPS_MAX_LISTS', 100))
+
+# How deeply expressions may be nested
+MAX_NESTING = 10
+
+OPERATIONS = ('union', 'intersection', 'difference')
+
+# Same order as parse_members
+BUCKETS = ('users', 'lists', 'emails', 'kerberos')
+
+
+def parse_flag(name, value):
+    """
+    Parses a boolean in the body (see util.parse_bool).
+    Raises ValueError if it is invalid.
+    """
+    try:
+        return parse_bool(value)
+    except Exception:
+        raise ValueError(f'{name} must be a boolean, not {json.dumps(value)}')
+
+
+def parse_expression(expression, recurse=False, depth=0):
+    """
+    Checks an expression and normalizes it into
+    ('list', name, recurse) and (operation, [operands]) tuples.
+
+    Raises ValueError if it is invalid.
+    """
+    if depth > MAX_NESTING:
+        raise ValueError(f'expressions can be nested at most {MAX_NESTING} times')
+    if isinstance(expression, str):
+        return ('list', expression, recurse)
+    if not isinstance(expression, dict) or len(expression) not in (1, 2):
+        raise ValueError(f'invalid expression: {expression!r}')
+    if 'list' in expression:
+        if not isinstance(expression['list'], str) or set(expression) - {'list', 'recurse'}:
+            raise ValueError(f'invalid list: {expression!r}')
+        return ('list', expression['list'], parse_flag('recurse', expression.get('recurse', recurse)))
+    if len(expression) != 1:
+        raise ValueError(f'invalid expression: {expression!r}')
+    (operation, operands), = expression.items()
+    if operation not in OPERATIONS:
+        raise ValueError(f'unknown operation {operation!r} (try one of: {", ".join(OPERATIONS)})')
+    if not isinstance(operands, list) or not operands:
+        raise ValueError(f'{operation} needs a non-empty array of expressions')
+    return (operation, [parse_expression(operand, recurse, depth + 1) for operand in operands])
+
+
+def _lists_in(expression):
+    if expression[0] == 'list':
+        yield expression[1:]
+    else:
+        for operand in expression[1]:
+            yield from _lists_in(operand)
+
+
+def _union(arrays):
+    result = array('I')
+    last = None
+    for member in heapq.merge(*arrays):
+        if member != last:
+            result.append(member)
+            last = member
+    return result
+
+
+def _intersection(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    # Binary search the longer array for each member of the shorter one
+    result = array('I')
+    lo = 0
+    for member in a:
+        lo = bisect.bisect_left(b, member, lo)
+        if lo == len(b):
+            break
+        if b[lo] == member:
+            result.append(member)
+    return result
+
+
+def _difference(a, b):
+    result = array('I')
+    lo = 0
+    for member in a:
+        lo = bisect.bisect_left(b, member, lo)
+        if lo == len(b) or b[lo] != member:
+            result.append(member)
+    return result
+
+
+def _evaluate(expression, arrays):
+    if expression[0] == 'list':
+        return arrays[expression[1:]]
+    operation, operands = expression
+    values = [_evaluate(operand, arrays) for operand in operands]
+    if operation == 'union':
+        return _union(values)
+    result = values[0]
+    for value in values[1:]:
+        result = _intersection(result, value) if operation == 'intersection' else _difference(result, value)
+    return result
+
+
+def evaluate(moira_query, expression):
+    """
+    Evaluates a parsed expression, and returns the result as a sorted array of
+    member ids, along with the (bucket, name) of each id
+    """
+    lists = list(dict.fromkeys(_lists_in(expression)))
+    if len(lists) > MAX_LISTS:
+        raise ValueError(f'expressions may use at most {MAX_LISTS} lists')
+
+    def query(recurse):
+        return 'get_end_members_of_list' if recurse else 'get_members_of_list'
+
+    loader = Loader(moira_query)
+    loader.load((query(recurse), name) for name, recurse in lists)
+    members_of = {}
+    for name, recurse in lists:
+        result = loader.get(query(recurse), name)
+        if isinstance(result, Exception):
+            raise result
+        members = parse_members(result)
+        members_of[(name, recurse)] = [
+            (bucket_index, member)
+            for bucket_index, bucket in enumerate(BUCKETS)
+            for member in members[bucket]
+        ]
+
+    # Numbering members in output order means every array is sorted
+    # by the same order they will be output in
+    members = sorted({member for list_members in members_of.values() for member in list_members})
+    ids = {member: i for i, member in enumerate(members)}
+    arrays = {
+        key: array('I', sorted({ids[member] for member in list_members}))
+        for key, list_members in members_of.items()
+    }
+    return _evaluate(expression, arrays), members
+
+
+def to_buckets(result, members):
+    buckets = {bucket: [] for bucket in BUCKETS}
+    for member_id in result:
+        bucket_index, name = members[member_id]
+        buckets[BUCKETS[bucket_index]].append(name)
+    return buckets
+
+
+def to_lines(result, members, chunk_size=1000):
+    """
+    Generator of the result as JSON lines ({"type": bucket, "name": name}),
+    a chunk at a time
+    """
+    for start in range(0, len(result), chunk_size):
+        yield ''.join(
+            json.dumps({'type': BUCKETS[members[member_id][0]], 'name': members[member_id][1]}) + '\n'
+            for member_id in result[start:start + chunk_size]
+        )
+
+
+def to_counts(result, members):
+    counts = {bucket: 0 for bucket in BUCKETS}
+    for member_id in result:
+        counts[BUCKETS[members[member_id][0]]] += 1
+    return counts
@@ -7,7 +7,7 @@ setup(
     author="Gabriel Rodríguez",
     author_email="rgabriel@mit.edu",
     license="MIT",
-    py_modules=["api", "decorators", "make_ccache", "util", "moira_query"],
+    py_modules=["api", "decorators", "make_ccache", "util", "moira_query", "list_search", "admission", "deadlines", "mailman", "timing", "query_cache", "list_watch", "moira_worker", "moira_client", "cache_backend", "jobs", "profiling", "expand", "setops", "sqlite_db"],
     # TODO: might the name(s) conflict?
     # In theory we should only need to export one (api right now)
     # But we need to `import decorators`
@@ -0,0 +1,65 @@
+"""
+SQLite databases shared by the threads and processes of a host (see
+cache_backend, admission and jobs).
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+
+class SQLiteDatabase:
+    """
+    A SQLite database (in WAL mode) that any thread may use: connections
+    can't be shared between threads, nor survive a fork, so each thread
+    gets its own, made again after a fork.
+
+    The file is only readable by the user running the API, since what is
+    kept in these databases may include Kerberos tickets. It is made the
+    first time a connection is needed, and `setup` (if given) is called
+    with every new connection, e.g. to create tables.
+    """
+
+    def __init__(self, path, timeout=10, setup=None, row_factory=None, synchronous=None):
+        self.path = path
+        self.timeout = timeout
+        self.setup = setup
+        self.row_factory = row_factory
+        self.synchronous = synchronous
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            # Make sure the file is private before anything is written to it
+            os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            if self.row_factory is not None:
+                db.row_factory = self.row_factory
+            db.execute('PRAGMA journal_mode=WAL')
+            if self.synchronous is not None:
+                db.execute(f'PRAGMA synchronous={self.synchronous}')
+            if self.setup is not None:
+                self.setup(db)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def execute(self, *args):
+        return self.connection().execute(*args)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager for a write transaction (started right away, so that
+        what it reads can't change before it writes), giving the connection
+        """
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
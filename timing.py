@@ -0,0 +1,121 @@
+"""
+Per-request stage timing, to find out where a slow request spent its time.
+
+Code wraps each stage in `with span('name'):`. Spans can be nested, and
+each one is only charged for its own time (not its children's), so the
+stages of a request add up to (roughly) its total time. Spans with the
+same name are added together.
+
+At the end of the request, the timings are sent in a Server-Timing
+response header and logged as one JSON line, along with a request id.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import uuid
+
+# Where the JSON lines go is up to the app (see REQUEST_LOG in api.create_app)
+logger = logging.getLogger('moira_api.requests')
+
+
+class _RequestTimings:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        # name -> [seconds, count], in the order they first happened
+        self.spans: dict[str, list] = {}
+        # Time spent in the children of each open span
+        self.stack: list[float] = []
+
+    def add(self, name, seconds, own_seconds=None):
+        if own_seconds is None:
+            own_seconds = seconds
+        entry = self.spans.setdefault(name, [0.0, 0])
+        entry[0] += own_seconds
+        entry[1] += 1
+        if self.stack:
+            self.stack[-1] += seconds
+
+
+# Timings of the current request (None outside of requests)
+_timings: contextvars.ContextVar[_RequestTimings | None] = contextvars.ContextVar('timings', default=None)
+
+
+def start_request(request_id=None):
+    """
+    Starts timing a request. The request id may be given by the client
+    (e.g. a proxy), otherwise a random one is made up.
+    """
+    if not request_id or len(request_id) > 128 or not request_id.isprintable():
+        request_id = uuid.uuid4().hex
+    timings = _RequestTimings(request_id)
+    _timings.set(timings)
+    return timings.request_id
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Times the code inside the `with` block as the given stage
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    timings.stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        children = timings.stack.pop()
+        timings.add(name, elapsed, elapsed - children)
+
+
+def detach():
+    """
+    Stops timing in the current context, e.g. in a thread doing part of a
+    request at the same time as others (whose stages would overlap)
+    """
+    _timings.set(None)
+
+
+def add(name, seconds):
+    """
+    Records a stage that was timed somewhere else (e.g. in a Moira worker process)
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def end_request(response, method, path):
+    """
+    Adds the Server-Timing header to the response and logs the timings
+    """
+    timings = _timings.get()
+    if timings is None:
+        return response
+    _timings.set(None)
+    total = time.perf_counter() - timings.start
+
+    response.headers['Server-Timing'] = ', '.join(
+        [f'{name};dur={seconds * 1000:.2f}' for name, (seconds, _) in timings.spans.items()] +
+        [f'total;dur={total * 1000:.2f}']
+    )
+    response.headers['X-Request-Id'] = timings.request_id
+    logger.info(json.dumps({
+        'request_id': timings.request_id,
+        'method': method,
+        'path': path,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 2),
+        'spans': {
+            name: {'ms': round(seconds * 1000, 2), 'count': count}
+            for name, (seconds, count) in timings.spans.items()
+        },
+    }))
+    return response
@@ -35,6 +35,20 @@ def parse_bool(param):
         raise Exception(f'invalid boolean: {param}')
 
 
+"""
+Gets the qualified_get_lists arguments (active, public, hidden,
+maillist, group) from the GET parameters of a request
+"""
+def parse_list_filters(args):
+    return (
+        args.get('active', 'true').upper(),
+        args.get('public', 'true').upper(),
+        args.get('hidden', 'false').upper(),
+        args.get('is_mailing_list', 'true').upper(),
+        args.get('is_afs_group', 'dontcare').upper(),
+    )
+
+
 """
 Parses a mailing list entry dict
 into the names we want for our API
@@ -50,6 +64,89 @@ def parse_list_dict(entry):
     }
 
 
+"""
+Parses the output of get_list_info
+into the names we want for our API
+"""
+def parse_list_info(res):
+    return {
+        'name': res['name'],
+        'description': res['description'],
+        'active': parse_bool(res['active']),
+        'public': parse_bool(res['publicflg']),
+        'hidden': parse_bool(res['hidden']),
+        'is_mailing_list': parse_bool(res['maillist']),
+        'is_afs_group': parse_bool(res['grouplist']),
+        'is_nfs_group': parse_bool(res['nfsgroup']),
+        'is_physical_access': parse_bool(res['pacslist']),
+        'is_mailman_list': parse_bool(res['mailman']),
+        'owner': {
+            'type': res['ace_type'].lower(),
+            'name': res['ace_name'],
+        },
+        'membership_administrator': None if res['memace_type'] == 'NONE' else {
+            'type': res['memace_type'].lower(),
+            'name': res['memace_name'],
+        },
+        'last_modified': {
+            'time': res['modtime'],
+            'user': res['modby'],
+            'tool': res['modwith'],
+        },
+    }
+
+
+"""
+Parses the output of get_user_by_login
+into the names we want for our API
+(`kerb` is passed in, as GET /users/{user}/ has always returned the caller's)
+"""
+def parse_user(res, kerb):
+    if res['middle']:
+        full_name = f"{res['first']} {res['middle']} {res['last']}"
+    else:
+        full_name = f"{res['first']} {res['last']}"
+
+    return {
+        'full_name': full_name,
+        'names': {
+            'first': res['first'],
+            'middle': res['middle'],
+            'last': res['last'],
+        },
+        'kerb': kerb,
+        'mit_id': res['clearid'],
+        'class_year': res['class'],
+    }
+
+
+"""
+Sorts the output of get_members_of_list (or get_end_members_of_list)
+into users, lists, emails and kerberos principals
+"""
+def parse_members(res):
+    members = {
+        'users': [],
+        'lists': [],
+        'emails': [],
+        'kerberos': [],
+    }
+    for member in res:
+        name = member['member_name']
+        member_type = member['member_type']
+        if member_type == 'USER':
+            members['users'].append(name)
+        elif member_type == 'LIST':
+            members['lists'].append(name)
+        elif member_type == 'STRING':
+            members['emails'].append(name)
+        elif member_type == 'KERBEROS':
+            members['kerberos'].append(name)
+        else:
+            raise Exception(f'unrecognized member type {member_type}')
+    return members
+
+
 """
 Parse a parameter as a bool-like "1" or "0"
 for use in Moira queries
@@ -89,7 +186,7 @@ From the output of get_list_info, prepare it as input
 for update_list. If this is passed without modification
 to update_list, it should be a no-op.
 """
-def create_update_list_input(list_name):
+def create_update_list_input(moira_query, list_name):
     # Get current attributes
     attributes = moira_query('get_list_info', list_name)[0]
     # Delete modified attributes